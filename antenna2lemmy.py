@@ -8,16 +8,53 @@ import hjson
 import html
 import time
 import threading
+import queue
+import concurrent.futures
 import curses
 import logging
-import io
 import yt_dlp
 import os
+import sqlite3
+import hashlib
+import shutil
+import tempfile
+import itertools
+import uuid
+import contextlib
+import http.server
+import zlib
+import gzip
+# Only needed to import straight into the database of Lemmy
+try:
+	import psycopg2
+	import psycopg2.extras
+	import psycopg2.pool
+except ImportError:
+	psycopg2 = None
+import collections
+import re
+import subprocess
+
+# Links can be split among several worker processes, each of them started with its share as --shard=number/total
+WORKERS = 1
+SHARD = None
+for argument in sys.argv[1:]:
+	if argument.startswith("--workers="):
+		WORKERS = int(argument.split("=")[1])
+	elif argument.startswith("--shard="):
+		SHARD, WORKERS = [int(number) for number in argument.split("=")[1].split("/")]
 
-logging.basicConfig(filename='migration.log', encoding='utf-8', level=logging.INFO, filemode="w")
+# Worker processes add to the log of the process that started them
+if SHARD is None:
+	open("migration.log", "w").close()
+logging.basicConfig(filename='migration.log', encoding='utf-8', level=logging.INFO, filemode="a")
 logger = logging.getLogger(__name__)
 
 DEBUGMODE = True if os.environ.get("DEBUGMODE", 0) == "1" else False
+if DEBUGMODE and SHARD is None:
+	WORKERS = 1
+# The worker processes share the limits of the servers, each of them gets its part
+SHARES = WORKERS if SHARD is not None else 1
 
 # Amount of time the program has been running
 start_time = time.time()
@@ -30,90 +67,1039 @@ with open("config.hjson", "r") as infile:
 LEMMYHOST = config["lemmy-conn"]["host"]
 ARCHIVEUSER = config["lemmy-conn"]["user"]
 ARCHIVEUSER_PW = config["lemmy-conn"]["password"]
+# Longest title and body Lemmy takes, longer bodies continue on comments
+TITLE_MAX = config["lemmy-conn"]["max_title"]
+BODY_MAX = config["lemmy-conn"]["max_body"]
+CONTINUED = "*(continued)*\n\n"
 PROTOCOL = config["lemmy-conn"]["protocol"]
 ORIGINHEADERS = {
 	'User-agent': config["origin-conn"]["user-agent"]
 }
+ORIGINHOST = config["origin-conn"]["host"]
+MORECHILDREN_BATCH = config["origin-conn"]["morechildren_batch"]
 BASE_API = PROTOCOL + "://" + LEMMYHOST + "/api/v3"
+PICTRS_API = PROTOCOL + "://" + LEMMYHOST + "/pictrs/image"
+
+# Connection pooling options
+ORIGIN_POOL_SIZE = config["http-pools"]["origin_pool_size"]
+API_POOL_SIZE = config["http-pools"]["api_pool_size"]
+PICTRS_POOL_SIZE = config["http-pools"]["pictrs_pool_size"]
+TIMEOUT = (config["http-pools"]["connect_timeout"], config["http-pools"]["read_timeout"])
+KEEPALIVE = config["http-pools"]["keepalive"]
 
 # Runtime options
 THREADING = config["script-options"]["threading"]
-MAXTHREADS = config["script-options"]["max_threads"]
+# Worker processes split every limit among them
+MAXTHREADS = max(1, config["script-options"]["max_threads"] // SHARES)
+FETCHTHREADS = max(1, config["script-options"]["max_fetch_threads"] // SHARES)
+PREFETCH_QUEUE = config["script-options"]["prefetch_queue"]
+# Optionally publish as many posts at once as the instance handles well, between a minimum and maximum
+ADAPTIVE = config["adaptive-concurrency"]["enabled"]
+ADAPTIVE_MIN = max(1, config["adaptive-concurrency"]["min_posts"] // SHARES)
+ADAPTIVE_MAX = max(1, config["adaptive-concurrency"]["max_posts"] // SHARES)
+ADAPTIVE_TARGET = config["adaptive-concurrency"]["latency_target"]
+ADAPTIVE_COOLDOWN = config["adaptive-concurrency"]["cooldown"]
+
+# Separate concurrency limits for each kind of remote work, shared by all the post workers
+ORIGIN_SLOTS = threading.BoundedSemaphore(max(1, config["script-options"]["max_origin_requests"] // SHARES))
+PICTRS_SLOTS = threading.BoundedSemaphore(max(1, config["script-options"]["max_pictrs_uploads"] // SHARES))
+API_SLOTS = threading.BoundedSemaphore(max(1, config["script-options"]["max_api_requests"] // SHARES))
+
+# Comments of every post are created by a shared set of workers, one at a time when debugging
+COMMENT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers = 1 if DEBUGMODE else max(1, config["script-options"]["max_comment_threads"] // SHARES))
+
+# Client side rate limits, matching the local_site_rate_limit of the instance
+RATELIMIT_BACKOFF_INITIAL = config["rate-limits"]["backoff_initial"]
+RATELIMIT_BACKOFF_MAX = config["rate-limits"]["backoff_max"]
 
 # Decisions of media migration
 MIGRATE_PICTURES = config["script-options"]["migrateimages"]
 MIGRATE_VIDEOS = config["script-options"]["migratevideos"]
 MEDIA_SKIP_ON_FAIL = config["script-options"]["media_skip_on_fail"]
+# Posts and comments are created through the API or imported straight into the database of Lemmy
+BACKEND = config["script-options"]["backend"]
+DB_BATCH = config["lemmy-db"]["batch"]
+# What to do with links that end up at a post already migrated to the same community
+DUPLICATES = config["script-options"]["duplicates"]
 
 # Decisions of comment migration
 MIGRATE_COMMENTS = config["script-options"]["migratecomments"]
 
+# Where to keep track of the progress to resume interrupted migrations
+JOURNAL_FILE = config["script-options"]["journal"]
+
+# What we keep of the downloaded posts and comments
+POST_FIELDS = ["id", "name", "permalink", "title", "author", "created_utc", "score", "is_self", "url", "selftext", "gallery_data", "media_metadata"]
+COMMENT_FIELDS = ["id", "name", "parent_id", "author", "created_utc", "score", "body"]
+
+# Local copies of downloaded media
+MEDIA_CACHE_DIR = config["media-cache"]["directory"]
+MEDIA_CACHE_MAX_BYTES = config["media-cache"]["max_mb"] * 1024 * 1024
+
+# How the progress is shown, on a curses screen or as a periodic status line when running without a terminal
+INTERFACE = config["interface"]["mode"]
+STATUS_INTERVAL = config["interface"]["status_interval"]
+# Only the most recent messages are kept for the screen, all of them are still in migration.log
+RECENT_LOG = collections.deque(maxlen = config["interface"]["log_lines"])
+
+# Where to expose the metrics of the migration
+METRICS_PORT = config["metrics"]["port"]
+METRICS_FILE = config["metrics"]["snapshot_file"]
+METRICS_INTERVAL = config["metrics"]["snapshot_interval"]
+# Worker processes only write their own snapshot often, the process that started them serves and shows them all together
+if SHARD is not None:
+	METRICS_PORT = 0
+	METRICS_FILE = (METRICS_FILE or "metrics.json") + ".shard" + str(SHARD)
+	METRICS_INTERVAL = 1
+
+# How media goes from the origin to pictrs
+STREAM_IMAGES = config["media-transfer"]["stream_images"]
+CHUNK_SIZE = config["media-transfer"]["chunk_kb"] * 1024
+SPOOL_MAX_BYTES = config["media-transfer"]["spool_mb"] * 1024 * 1024
+MEDIA_TEMP_DIR = config["media-transfer"]["temp_directory"]
+MEDIA_MAX_BYTES = config["media-transfer"]["max_mb"] * 1024 * 1024
+os.makedirs(MEDIA_TEMP_DIR, exist_ok = True)
+# Media of the same post is transferred at once up to MEDIA_PER_POST, by workers shared with the rest of posts
+MEDIA_PER_POST = config["media-transfer"]["post_concurrency"]
+MEDIA_POOL = concurrent.futures.ThreadPoolExecutor(max_workers = 1 if DEBUGMODE else max(1, config["media-transfer"]["concurrency"] // SHARES))
+
+# Big videos can be made smaller with ffmpeg before uploading them, with their own limit of simultaneous conversions
+TRANSCODE = config["transcode"]["enabled"]
+TRANSCODE_FFMPEG = config["transcode"]["ffmpeg"]
+TRANSCODE_SLOTS = threading.BoundedSemaphore(max(1, config["transcode"]["workers"] // SHARES))
+TRANSCODE_ABOVE_BYTES = config["transcode"]["above_mb"] * 1024 * 1024
+TRANSCODE_MAX_HEIGHT = config["transcode"]["max_height"]
+TRANSCODE_VIDEO_KBPS = config["transcode"]["video_kbps"]
+TRANSCODE_AUDIO_KBPS = config["transcode"]["audio_kbps"]
+TRANSCODE_PRESET = config["transcode"]["preset"]
+
+
+class Metrics:
+	# Time spent on each stage of the migration, bytes transferred, rate limit errors and waits, shared by all the threads
+	BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Histograms of seconds by stage: a count for each bucket plus the total count and sum
+		self.stages = {}
+		# Counters by name and optional action
+		self.counters = {}
+		# Current values that go up and down, by name
+		self.gauges = {}
+
+	def observe(self, stage, seconds):
+		with self.lock:
+			histogram = self.stages.setdefault(stage, {"buckets": [0] * len(self.BUCKETS), "count": 0, "sum": 0})
+			for number, bound in enumerate(self.BUCKETS):
+				if seconds <= bound:
+					histogram["buckets"][number] += 1
+			histogram["count"] += 1
+			histogram["sum"] += seconds
+
+	@contextlib.contextmanager
+	def timed(self, stage):
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(stage, time.monotonic() - start)
+
+	def increment(self, name, amount = 1, action = None):
+		with self.lock:
+			self.counters[(name, action)] = self.counters.get((name, action), 0) + amount
+
+	def value(self, name, action = None):
+		with self.lock:
+			return self.counters.get((name, action), 0)
+
+	def setgauge(self, name, value):
+		with self.lock:
+			self.gauges[name] = value
+
+	def gauge(self, name):
+		with self.lock:
+			return self.gauges.get(name, 0)
+
+	def load(self, snapshots):
+		# Replace everything with the sum of the snapshots written by other processes
+		counters = {}
+		stages = {}
+		gauges = {}
+		for snapshot in snapshots:
+			for name, value in snapshot.get("gauges", {}).items():
+				gauges[name] = gauges.get(name, 0) + value
+			for name, value in snapshot["counters"].items():
+				for action, amount in (value.items() if isinstance(value, dict) else [(None, value)]):
+					counters[(name, action)] = counters.get((name, action), 0) + amount
+			for stage, histogram in snapshot["stages"].items():
+				merged = stages.setdefault(stage, {"buckets": [0] * len(self.BUCKETS), "count": 0, "sum": 0})
+				merged["buckets"] = [total + count for total, count in zip(merged["buckets"], histogram["buckets"].values())]
+				merged["count"] += histogram["count"]
+				merged["sum"] += histogram["seconds"]
+		with self.lock:
+			self.counters = counters
+			self.stages = stages
+			self.gauges = gauges
+
+	def snapshot(self):
+		with self.lock:
+			counters = {}
+			for (name, action), value in self.counters.items():
+				if action:
+					counters.setdefault(name, {})[action] = value
+				else:
+					counters[name] = value
+			stages = {}
+			for stage, histogram in self.stages.items():
+				stages[stage] = {
+					"count": histogram["count"],
+					"seconds": round(histogram["sum"], 3),
+					"average": round(histogram["sum"] / histogram["count"], 3),
+					"buckets": dict(zip([str(bound) for bound in self.BUCKETS], histogram["buckets"]))
+				}
+			gauges = dict(self.gauges)
+		return {"time": time.time(), "runtime": round(time.time() - start_time), "counters": counters, "gauges": gauges, "stages": stages}
+
+	def prometheus(self):
+		# Text exposition format
+		lines = ["# TYPE antenna2lemmy_stage_seconds histogram"]
+		with self.lock:
+			for stage, histogram in sorted(self.stages.items()):
+				for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+					lines.append(f'antenna2lemmy_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+				lines.append(f'antenna2lemmy_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+				lines.append(f'antenna2lemmy_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+				lines.append(f'antenna2lemmy_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+			for (name, action), value in sorted(self.counters.items(), key = lambda item: (item[0][0], item[0][1] or "")):
+				if f"# TYPE antenna2lemmy_{name}_total counter" not in lines:
+					lines.append(f"# TYPE antenna2lemmy_{name}_total counter")
+				labels = f'{{action="{action}"}}' if action else ""
+				lines.append(f"antenna2lemmy_{name}_total{labels} {value}")
+			for name, value in sorted(self.gauges.items()):
+				lines.append(f"# TYPE antenna2lemmy_{name} gauge")
+				lines.append(f"antenna2lemmy_{name} {value}")
+		return "\n".join(lines) + "\n"
+
+	def serve(self, port):
+		metrics = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.prometheus().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+		server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		server.daemon_threads = True
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+
+	def writesnapshots(self, filename, interval):
+		# Periodically dump everything into a file, the last one stays there once the migration ends
+		def writer():
+			while True:
+				time.sleep(interval)
+				self.writesnapshot(filename)
+		threading.Thread(target = writer, daemon = True).start()
+
+	def writesnapshot(self, filename):
+		with open(filename + ".part", "w") as outfile:
+			json.dump(self.snapshot(), outfile, indent = 1)
+		os.replace(filename + ".part", filename)
+
+METRICS = Metrics()
+def buildsession(poolsize, headers = {}):
+	# A session keeps a pool of open connections per host so we don't pay a new TCP/TLS handshake on every request
+	session = requests.Session()
+	adapter = requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = poolsize)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	session.headers.update(headers)
+	if not KEEPALIVE:
+		session.headers["Connection"] = "close"
+	return session
+
+# Shared by all the threads, one for each of the hosts we talk to
+ORIGIN_SESSION = buildsession(ORIGIN_POOL_SIZE, ORIGINHEADERS)
+API_SESSION = buildsession(API_POOL_SIZE)
+PICTRS_SESSION = buildsession(PICTRS_POOL_SIZE)
+
+class TokenBucket:
+	# Allows up to capacity actions every interval seconds, refilling continuously, shared by all the threads
+	def __init__(self, capacity, interval):
+		self.capacity = capacity
+		self.rate = capacity / interval if capacity else 0
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		# When the instance still rate limits us everyone waits until this moment, growing the backoff on each new error
+		self.blocked_until = 0
+		self.backoff = 0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		# A capacity of 0 disables the limit for this action
+		if not self.capacity:
+			return
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if now >= self.blocked_until and self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+			time.sleep(wait)
+
+	def penalize(self):
+		# The instance rate limited us anyway, so empty the bucket and make every thread back off together
+		with self.lock:
+			now = time.monotonic()
+			# Errors from requests that were already in flight during the current backoff don't grow it again
+			if now >= self.blocked_until:
+				self.backoff = min(RATELIMIT_BACKOFF_MAX, self.backoff * 2 if self.backoff else RATELIMIT_BACKOFF_INITIAL)
+				self.blocked_until = now + self.backoff
+			self.tokens = 0
+			self.updated = now
+			return self.blocked_until - now
+
+	def relax(self):
+		with self.lock:
+			self.backoff = 0
+
+RATE_LIMITS = {
+	action: TokenBucket(config["rate-limits"][action], config["rate-limits"][action + "_per_second"] * SHARES)
+	for action in ["post", "comment", "image"]
+}
+
+class ConcurrencyLimit:
+	# Amount of posts published at once. It grows by one after each round of quick answers from Lemmy and pictrs
+	# and halves when they time out, fail or rate limit us, staying between minimum and maximum
+	def __init__(self, start, minimum, maximum, target, cooldown):
+		self.minimum = minimum
+		self.maximum = maximum
+		self.limit = min(maximum, max(minimum, start))
+		self.target = target
+		self.cooldown = cooldown
+		self.inflight = 0
+		self.decreased = 0
+		self.condition = threading.Condition()
+		METRICS.setgauge("posts_limit", int(self.limit))
+
+	@contextlib.contextmanager
+	def slot(self):
+		with self.condition:
+			while self.inflight >= int(self.limit):
+				self.condition.wait()
+			self.inflight += 1
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.inflight -= 1
+				self.condition.notify()
+
+	def succeed(self, seconds):
+		# Slow answers don't grow it, but aren't a reason to shrink it either
+		if seconds > self.target:
+			return
+		with self.condition:
+			self.limit = min(self.maximum, self.limit + 1 / self.limit)
+			self.condition.notify_all()
+			METRICS.setgauge("posts_limit", int(self.limit))
+
+	def fail(self):
+		with self.condition:
+			now = time.monotonic()
+			# Requests that were already in flight will likely fail too, so only shrink it once for all of them
+			if now - self.decreased < self.cooldown:
+				return
+			self.decreased = now
+			self.limit = max(self.minimum, self.limit / 2)
+			METRICS.setgauge("posts_limit", int(self.limit))
+
+# Without adaptive concurrency the limit stays at max_threads
+if ADAPTIVE:
+	CONCURRENCY = ConcurrencyLimit(MAXTHREADS, ADAPTIVE_MIN, ADAPTIVE_MAX, ADAPTIVE_TARGET, ADAPTIVE_COOLDOWN)
+else:
+	CONCURRENCY = ConcurrencyLimit(MAXTHREADS, MAXTHREADS, MAXTHREADS, 0, 0)
+
+def lemmypost(action, url, context, **kwargs):
+	# Send a creation request to Lemmy at the allowed rate of its action, retrying for as long as it still rate limits us
+	bucket = RATE_LIMITS[action]
+	slots, session = (PICTRS_SLOTS, PICTRS_SESSION) if action == "image" else (API_SLOTS, API_SESSION)
+	while True:
+		# Time spent waiting for the rate limits to allow us
+		waited = time.monotonic()
+		bucket.acquire()
+		METRICS.increment("ratelimit_wait_seconds", time.monotonic() - waited, action)
+		# Uploads are read again from the start on each attempt
+		if hasattr(kwargs.get("data"), "seek"):
+			kwargs["data"].seek(0)
+		try:
+			with slots, METRICS.timed("lemmy_" + action):
+				started = time.monotonic()
+				response = session.post(url = url, timeout = TIMEOUT, **kwargs)
+				elapsed = time.monotonic() - started
+		except requests.exceptions.RequestException:
+			CONCURRENCY.fail()
+			raise
+		try:
+			ratelimited = response.status_code == 429 or response.json().get("error", "ok") == "rate_limit_error"
+		except (json.decoder.JSONDecodeError, AttributeError):
+			ratelimited = False
+		if not ratelimited:
+			bucket.relax()
+			# Let the amount of posts at once follow how well the instance copes
+			if response.status_code >= 500:
+				CONCURRENCY.fail()
+			else:
+				CONCURRENCY.succeed(elapsed)
+			return response
+		CONCURRENCY.fail()
+		METRICS.increment("retries", 1, action)
+		wait = bucket.penalize()
+		log("Timed out and waiting " + str(round(wait)) + " seconds. " + context + ", response: '" + response.text, "warning")
+
+class Journal:
+	# Durable record of how far each post got, so restarting the program skips the work already done
+	def __init__(self, filename):
+		# An empty filename keeps the journal in memory only
+		# Worker processes share the same file, waiting for each other to write
+		self.db = sqlite3.connect(filename or ":memory:", check_same_thread = False, isolation_level = None, timeout = 60)
+		self.lock = threading.Lock()
+		with self.lock:
+			self.db.execute("PRAGMA journal_mode=WAL")
+			self.db.execute("CREATE TABLE IF NOT EXISTS posts (community_id INTEGER, url TEXT, state TEXT, post_id INTEGER, media_url TEXT, PRIMARY KEY (community_id, url))")
+			self.db.execute("CREATE TABLE IF NOT EXISTS comments (post_id INTEGER, origin_id TEXT, comment_id INTEGER, PRIMARY KEY (post_id, origin_id))")
+			self.db.execute("CREATE TABLE IF NOT EXISTS media (origin_url TEXT PRIMARY KEY, hash TEXT, new_url TEXT)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS media_hash ON media (hash)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS prefetch (url TEXT PRIMARY KEY, data BLOB)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS canonical (url TEXT PRIMARY KEY, name TEXT)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS claims (community_id INTEGER, name TEXT, url TEXT, PRIMARY KEY (community_id, name))")
+
+	def getpost(self, community_id, url):
+		with self.lock:
+			row = self.db.execute("SELECT state, post_id, media_url FROM posts WHERE community_id = ? AND url = ?", (community_id, url)).fetchone()
+		return {"state": row[0], "post_id": row[1], "media_url": row[2]} if row else None
+
+	def setpost(self, community_id, url, state, post_id = None, media_url = None):
+		# States go media -> posted -> completed, previous values are kept unless we have new ones
+		with self.lock:
+			self.db.execute(
+				"INSERT INTO posts VALUES (?, ?, ?, ?, ?) ON CONFLICT (community_id, url) DO UPDATE SET state = excluded.state, "
+				"post_id = COALESCE(excluded.post_id, post_id), media_url = COALESCE(excluded.media_url, media_url)",
+				(community_id, url, state, post_id, media_url)
+			)
+
+	def getduplicate(self, community_id, name, url):
+		# POST_ID of another link in the community that resolved to the same origin post
+		with self.lock:
+			row = self.db.execute(
+				"SELECT posts.post_id FROM posts JOIN canonical ON posts.url = canonical.url "
+				"WHERE posts.community_id = ? AND canonical.name = ? AND posts.url != ? AND posts.post_id IS NOT NULL ORDER BY posts.rowid",
+				(community_id, name, url)
+			).fetchone()
+		return row[0] if row else None
+
+	def isduplicate(self, community_id, name, url):
+		# Whether another link created the post first, the one this link was published as a duplicate of
+		with self.lock:
+			row = self.db.execute(
+				"SELECT 1 FROM posts JOIN canonical ON posts.url = canonical.url WHERE posts.community_id = ? AND canonical.name = ? AND posts.post_id IS NOT NULL "
+				"AND posts.rowid < (SELECT rowid FROM posts WHERE community_id = ? AND url = ?)",
+				(community_id, name, community_id, url)
+			).fetchone()
+		return row is not None
+
+	def setcomments(self, post_id, comments):
+		# Many pairs of origin comment id and COMMENT_ID at once
+		with self.lock:
+			self.db.executemany("INSERT OR REPLACE INTO comments VALUES (?, ?, ?)", [(post_id, origin_id, comment_id) for origin_id, comment_id in comments])
+
+	def getcomments(self, post_id):
+		# Map of origin comment id to the COMMENT_ID it already has in Lemmy
+		with self.lock:
+			return dict(self.db.execute("SELECT origin_id, comment_id FROM comments WHERE post_id = ?", (post_id,)).fetchall())
+
+	def setcomment(self, post_id, origin_id, comment_id):
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO comments VALUES (?, ?, ?)", (post_id, origin_id, comment_id))
+
+	def getmedia(self, origin_url):
+		with self.lock:
+			row = self.db.execute("SELECT hash, new_url FROM media WHERE origin_url = ?", (origin_url,)).fetchone()
+		return {"hash": row[0], "new_url": row[1]} if row else None
+
+	def getmediahash(self, digest):
+		# Any pictrs url that already holds this very same content
+		with self.lock:
+			row = self.db.execute("SELECT new_url FROM media WHERE hash = ? AND new_url IS NOT NULL", (digest,)).fetchone()
+		return row[0] if row else None
+
+	def setmedia(self, origin_url, digest, new_url = None):
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?)", (origin_url, digest, new_url))
+
+	def getprefetch(self, url):
+		# Post and comments already downloaded from the origin, stored compressed
+		with self.lock:
+			row = self.db.execute("SELECT data FROM prefetch WHERE url = ?", (url,)).fetchone()
+		return json.loads(zlib.decompress(row[0])) if row else None
+
+	def setprefetch(self, url, record):
+		data = zlib.compress(json.dumps(record, separators = (",", ":")).encode())
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO prefetch VALUES (?, ?)", (url, data))
+
+	def getcanonical(self, url):
+		# Full name of the origin post a link ends up at once crossposts are followed
+		with self.lock:
+			row = self.db.execute("SELECT name FROM canonical WHERE url = ?", (url,)).fetchone()
+		return row[0] if row else None
+
+	def setcanonical(self, url, name):
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO canonical VALUES (?, ?)", (url, name))
+
+	def claimpost(self, community_id, name, url):
+		# The link that gets to create the origin post in the community among every worker process, the first one to ask for it
+		with self.lock:
+			self.db.execute("INSERT OR IGNORE INTO claims VALUES (?, ?, ?)", (community_id, name, url))
+			return self.db.execute("SELECT url FROM claims WHERE community_id = ? AND name = ?", (community_id, name)).fetchone()[0]
+
+	def releasepost(self, community_id, name):
+		with self.lock:
+			self.db.execute("DELETE FROM claims WHERE community_id = ? AND name = ?", (community_id, name))
+
+	def clearclaims(self):
+		# Claims only last for a run, links of the next one might be different
+		with self.lock:
+			self.db.execute("DELETE FROM claims")
+
+class LemmyDatabase:
+	# Imports posts and comments straight into the tables of Lemmy keeping their dates and scores, only meant for communities that don't federate yet
+	def __init__(self, options, connections):
+		# The pool raises instead of waiting when all its connections are taken, so threads queue for them beforehand
+		self.slots = threading.BoundedSemaphore(connections)
+		self.pool = psycopg2.pool.ThreadedConnectionPool(1, connections, host = options["host"], port = options["port"], dbname = options["name"], user = options["user"], password = options["password"])
+		with self.transaction() as cursor:
+			cursor.execute("SELECT id FROM person WHERE name = %s AND local", (ARCHIVEUSER,))
+			self.creator_id = cursor.fetchone()[0]
+			# The ap_id of the rows must carry the public url of the instance, which might not be the host we connect to
+			cursor.execute("SELECT site.actor_id FROM site JOIN local_site ON local_site.site_id = site.id")
+			self.baseurl = cursor.fetchone()[0].rstrip("/")
+
+	@contextlib.contextmanager
+	def transaction(self):
+		# Everything done with the cursor is committed at once, or rolled back on failure
+		with self.slots:
+			connection = self.pool.getconn()
+			try:
+				with connection, connection.cursor() as cursor:
+					cursor.execute("SET TIME ZONE 'UTC'")
+					yield cursor
+			finally:
+				self.pool.putconn(connection)
+
+	def reserveids(self, cursor, table, amount):
+		# Knowing the ids beforehand lets us write the ap_id and path of each row on the same insert
+		cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", (table, amount))
+		return [row[0] for row in cursor.fetchall()]
+
+	def setscores(self, cursor, kind, scores):
+		# The rows of aggregates are created by the triggers of Lemmy, we only put back the original score
+		psycopg2.extras.execute_values(
+			cursor,
+			f"UPDATE {kind}_aggregates SET score = scores.score, upvotes = GREATEST(scores.score, 0), downvotes = GREATEST(-scores.score, 0) "
+			f"FROM (VALUES %s) AS scores (id, score) WHERE {kind}_aggregates.{kind}_id = scores.id",
+			scores, page_size = DB_BATCH
+		)
+
+	def insertpost(self, payload, postdata):
+		with self.transaction() as cursor:
+			POST_ID = self.reserveids(cursor, "post", 1)[0]
+			cursor.execute(
+				"INSERT INTO post (id, name, url, body, creator_id, community_id, published, ap_id, local) VALUES (%s, %s, %s, %s, %s, %s, to_timestamp(%s), %s, true)",
+				(POST_ID, payload["name"], payload["url"], payload["body"], self.creator_id, payload["community_id"], postdata["created_utc"], self.baseurl + "/post/" + str(POST_ID))
+			)
+			self.setscores(cursor, "post", [(POST_ID, postdata["score"] or 0)])
+		return POST_ID
+
+	def insertcomments(self, POST_ID, comments, migrated):
+		# Comments come parents first as (origin id, origin id of the parent, content, created_utc, score). Returns the COMMENT_ID of each of them
+		with self.transaction() as cursor:
+			# Replies to comments imported or created on a previous run need the path of their parent
+			cursor.execute("SELECT id, path::text FROM comment WHERE id = ANY(%s)", (list(migrated.values()),))
+			paths = dict(cursor.fetchall())
+			paths = {origin_id: paths[COMMENT_ID] for origin_id, COMMENT_ID in migrated.items() if COMMENT_ID in paths}
+			ids = dict(zip([comment[0] for comment in comments], self.reserveids(cursor, "comment", len(comments))))
+			rows = []
+			for origin_id, parent_id, content, created_utc, score in comments:
+				paths[origin_id] = paths.get(parent_id, "0") + "." + str(ids[origin_id])
+				rows.append((ids[origin_id], self.creator_id, POST_ID, content, created_utc, paths[origin_id], self.baseurl + "/comment/" + str(ids[origin_id])))
+			psycopg2.extras.execute_values(
+				cursor,
+				"INSERT INTO comment (id, creator_id, post_id, content, published, path, ap_id, local) VALUES %s",
+				rows, template = "(%s, %s, %s, %s, to_timestamp(%s), %s::ltree, %s, true)", page_size = DB_BATCH
+			)
+			self.setscores(cursor, "comment", [(ids[comment[0]], comment[4] or 0) for comment in comments])
+		return ids
+
+	def refresh(self, COMMUNITY_ID):
+		# Triggers count rows as they come, but comments imported out of order leave the newest comment times wrong.
+		# Rankings are set too, the scheduled job of Lemmy only updates recent posts and imported rows start at the top
+		with self.transaction() as cursor:
+			cursor.execute(
+				"UPDATE post_aggregates SET comments = counts.comments, newest_comment_time = counts.newest, newest_comment_time_necro = counts.newest, "
+				"hot_rank = hot_rank(post_aggregates.score::numeric, post_aggregates.published), hot_rank_active = hot_rank(post_aggregates.score::numeric, counts.newest) "
+				"FROM (SELECT post.id, count(comment.id) AS comments, COALESCE(max(comment.published), post.published) AS newest FROM post "
+				"LEFT JOIN comment ON comment.post_id = post.id AND NOT comment.deleted AND NOT comment.removed WHERE post.community_id = %s GROUP BY post.id) AS counts "
+				"WHERE post_aggregates.post_id = counts.id",
+				(COMMUNITY_ID,)
+			)
+			cursor.execute(
+				"UPDATE community_aggregates SET posts = (SELECT count(*) FROM post WHERE community_id = %s AND NOT deleted AND NOT removed), "
+				"comments = (SELECT count(*) FROM comment JOIN post ON post.id = comment.post_id WHERE post.community_id = %s AND NOT comment.deleted AND NOT comment.removed) "
+				"WHERE community_id = %s",
+				(COMMUNITY_ID, COMMUNITY_ID, COMMUNITY_ID)
+			)
+			cursor.execute(
+				"UPDATE comment_aggregates SET hot_rank = hot_rank(comment_aggregates.score::numeric, comment_aggregates.published) "
+				"FROM comment JOIN post ON post.id = comment.post_id WHERE comment_aggregates.comment_id = comment.id AND post.community_id = %s",
+				(COMMUNITY_ID,)
+			)
+
+class MediaCache:
+	# Downloaded media stored by content hash, evicting the least recently used files once over the size limit.
+	# The directory is only listed at start, then the size of every file is kept in memory from the least to the most recently used
+	def __init__(self, directory, maxbytes):
+		self.directory = directory
+		self.maxbytes = maxbytes
+		self.lock = threading.Lock()
+		self.files = collections.OrderedDict()
+		self.total = 0
+		if self.maxbytes:
+			os.makedirs(self.directory, exist_ok = True)
+			entries = [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".part")]
+			for entry in sorted(entries, key = lambda entry: entry.stat().st_mtime):
+				self.files[entry.name] = entry.stat().st_size
+				self.total += self.files[entry.name]
 
-# Load file of links provided
+	def read(self, digest):
+		if not self.maxbytes or not digest:
+			return None
+		filename = os.path.join(self.directory, digest)
+		try:
+			media = open(filename, "rb")
+		except FileNotFoundError:
+			return None
+		# Mark it as recently used, also on disk for the next run
+		os.utime(filename)
+		with self.lock:
+			if digest in self.files:
+				self.files.move_to_end(digest)
+		return media
+
+	def write(self, digest, media):
+		filename = os.path.join(self.directory, digest)
+		if not self.maxbytes or os.path.exists(filename):
+			return
+		media.seek(0, os.SEEK_END)
+		size = media.tell()
+		media.seek(0)
+		if size > self.maxbytes:
+			return
+		with open(filename + ".part", "wb") as outfile:
+			shutil.copyfileobj(media, outfile)
+		os.replace(filename + ".part", filename)
+		media.seek(0)
+		with self.lock:
+			self.total += size - self.files.pop(digest, 0)
+			self.files[digest] = size
+			self.evict()
+
+	def evict(self):
+		# Called with the lock held
+		while self.total > self.maxbytes and self.files:
+			digest, size = self.files.popitem(last = False)
+			self.total -= size
+			try:
+				os.remove(os.path.join(self.directory, digest))
+			# Worker processes share the directory, another one might have removed it already
+			except FileNotFoundError:
+				pass
+
+class MultipartUpload:
+	# multipart/form-data body for pictrs that is read in chunks from its source while sending, so the media is never whole in memory
+	def __init__(self, opener, length = None):
+		# The opener returns a new iterator over the chunks of the media each time the upload starts from the beginning
+		self.opener = opener
+		boundary = uuid.uuid4().hex
+		self.content_type = "multipart/form-data; boundary=" + boundary
+		self.head = ("--" + boundary + "\r\nContent-Disposition: form-data; name=\"images[]\"; filename=\"images[]\"\r\nContent-Type: application/octet-stream\r\n\r\n").encode()
+		self.tail = ("\r\n--" + boundary + "--\r\n").encode()
+		# Without a known length the body is sent with chunked transfer encoding
+		self.len = len(self.head) + length + len(self.tail) if length is not None else None
+		self.source = None
+		self.parts = None
+		self.buffer = b""
+
+	def seek(self, offset, whence = 0):
+		# Only rewinding is supported, and only needed if something was read already
+		if self.parts:
+			self.close()
+
+	def read(self, size = -1):
+		if not self.parts:
+			self.source = self.opener()
+			self.parts = itertools.chain([self.head], self.source, [self.tail])
+		while size < 0 or len(self.buffer) < size:
+			chunk = next(self.parts, None)
+			if chunk is None:
+				break
+			self.buffer += chunk
+		if size < 0:
+			size = len(self.buffer)
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		METRICS.increment("uploaded_bytes", len(data))
+		return data
+
+	def __iter__(self):
+		return iter(lambda: self.read(CHUNK_SIZE), b"")
+
+	def close(self):
+		if self.source and hasattr(self.source, "close"):
+			self.source.close()
+		self.source = None
+		self.parts = None
+		self.buffer = b""
+
+# Locks for work that only one thread should do at a time for the same key, like downloading the same url.
+# Each one counts the threads holding or waiting for it and is dropped once there are none left
+CLAIMS = {}
+CLAIMS_LOCK = threading.Lock()
+
+@contextlib.contextmanager
+def claim(key):
+	with CLAIMS_LOCK:
+		entry = CLAIMS.setdefault(key, [threading.Lock(), 0])
+		entry[1] += 1
+	try:
+		with entry[0]:
+			yield
+	finally:
+		with CLAIMS_LOCK:
+			entry[1] -= 1
+			if not entry[1]:
+				del CLAIMS[key]
+
+JOURNAL = Journal(JOURNAL_FILE)
+MEDIA_CACHE = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+# Load the migrations provided, each of them a target community and a file of links
+MODE = "both"
+MIGRATIONS = []
 try:
-	# we only get one argument
-	migrationinfo = sys.argv[1].split(",")
-	# Expand config values for this particular migration
-	COMMUNITY_NAME = migrationinfo[0]
-	ORIGIN = migrationinfo[1]
+	for argument in sys.argv[1:]:
+		# Optionally only download the posts into the journal, or only publish the ones downloaded before
+		if argument in ["fetch", "publish", "both"]:
+			MODE = argument
+		# A manifest file lists many of them, one per line
+		# Worker process options were read already
+		elif argument.startswith("--"):
+			continue
+		elif argument.startswith("@"):
+			with open(argument[1:], "r") as manifest:
+				MIGRATIONS += [line.strip().split(",") for line in manifest.read().splitlines() if line.strip()]
+		else:
+			MIGRATIONS.append(argument.split(","))
+	if not MIGRATIONS or any(len(migrationinfo) != 2 for migrationinfo in MIGRATIONS):
+		raise IndexError
+	# Links are read as the migration goes, only check the files are there
+	for migrationinfo in MIGRATIONS:
+		with open(migrationinfo[1], "rb"):
+			pass
 except IndexError:
-	print("Provide a valid text file and target community as argument to the program")
+	print("Provide one or more valid target community and text file pairs as arguments to the program, or a manifest file of them as @manifest.txt, optionally followed by fetch or publish and --workers=N to use N processes")
 	sys.exit(0)
-try:
-	with open(ORIGIN, "r") as urlsfile:
-		urls = urlsfile.read().splitlines()
-except FileNotFoundError:
-	print(f"The file {ORIGIN} does not exist")
+except FileNotFoundError as e:
+	print(f"The file {e.filename} does not exist")
 	sys.exit(0)
 
-# Obtain a login auth for the lemmy user
+# Worker processes sort out the links that lead to the same post through the journal, one in memory would be only their own
+if WORKERS > 1 and not JOURNAL_FILE:
+	print("Worker processes need a journal file to share, set one in config.hjson")
+	sys.exit(1)
+
+# Fetching alone doesn't need to talk to Lemmy at all, nor does starting the worker processes
+AUTH = None
+COMMUNITY_IDS = {}
+COORDINATOR = WORKERS > 1 and SHARD is None
+
+# Obtain a login auth for the lemmy user, shared by all the migrations
 payload = {
 	'username_or_email': ARCHIVEUSER,
 	'password': ARCHIVEUSER_PW
 }
 try:
-	response = requests.post(url = BASE_API + "/user/login", json = payload)
-	AUTH = response.json()["jwt"]
+	if MODE != "fetch" and not COORDINATOR:
+		response = API_SESSION.post(url = BASE_API + "/user/login", json = payload, timeout = TIMEOUT)
+		AUTH = response.json()["jwt"]
 except:
 	print("Failed to authenticate: " + response.text)
 	sys.exit(1)
 
-# Get community ID because we cannot target by name in API
-payload = {
-	'auth': AUTH,
-	'name': COMMUNITY_NAME
-}
-try:
-	COMMUNITY_ID = requests.get(url = BASE_API + "/community", params = payload).json()["community_view"]["community"]["id"]
-except:
-	print("Failed to get community ID for " + COMMUNITY_NAME + ", are you sure it exists?")
-	sys.exit(1)
+# Get community IDs because we cannot target by name in API, once for each community no matter how many files target it
+for COMMUNITY_NAME, ORIGIN in MIGRATIONS:
+	if MODE == "fetch" or COORDINATOR or COMMUNITY_NAME in COMMUNITY_IDS:
+		continue
+	payload = {
+		'auth': AUTH,
+		'name': COMMUNITY_NAME
+	}
+	try:
+		COMMUNITY_IDS[COMMUNITY_NAME] = API_SESSION.get(url = BASE_API + "/community", params = payload, timeout = TIMEOUT).json()["community_view"]["community"]["id"]
+	except:
+		print("Failed to get community ID for " + COMMUNITY_NAME + ", are you sure it exists?")
+		sys.exit(1)
+
+# Importing into the database only replaces the creation of posts and comments, login and media still go through Lemmy
+DATABASE = None
+if BACKEND == "database" and MODE != "fetch" and not COORDINATOR:
+	if not psycopg2:
+		print("Importing into the database needs psycopg2, install it with pip install psycopg2-binary")
+		sys.exit(1)
+	try:
+		DATABASE = LemmyDatabase(config["lemmy-db"], 1 if DEBUGMODE or not THREADING else CONCURRENCY.maximum)
+	except (psycopg2.Error, TypeError) as e:
+		print("Failed to connect to the database of Lemmy or find the user " + ARCHIVEUSER + ": " + str(e))
+		sys.exit(1)
+
+# How many posts schedule() remembers to skip duplicates before fetching them
+SEEN_POSTS = 100000
+
+def schedule():
+	# Take the posts of every migration in turns so all the communities advance together instead of waiting for each other to finish
+	pending = [communityposts(COMMUNITY_IDS.get(COMMUNITY_NAME), ORIGIN) for COMMUNITY_NAME, ORIGIN in MIGRATIONS]
+	# Only the most recent posts are remembered, duplicates further apart are caught by the journal when publishing
+	seen = collections.OrderedDict()
+	while pending:
+		for posts in list(pending):
+			post = next(posts, None)
+			if not post:
+				pending.remove(posts)
+				continue
+			# Different links to the same post, or to crossposts of it resolved on a previous run, only go through once for each community
+			COMMUNITY_ID, url = post
+			key = (COMMUNITY_ID, JOURNAL.getcanonical(url) or postname(url))
+			if key in seen:
+				log("Skipping duplicate. op: 'Migrating post', url: '" + url + "', post: '" + key[1] + "'", "info")
+				updatecounter('skipped_posts')
+				continue
+			seen[key] = None
+			if len(seen) > SEEN_POSTS:
+				seen.popitem(last = False)
+			yield post
+
+def postname(url):
+	# Full name of the origin post the link points to, the link itself if it doesn't look like one
+	match = re.search(r"/comments/([a-z0-9]+)", url)
+	return "t3_" + match.group(1) if match else url
+
+def communityposts(COMMUNITY_ID, filename):
+	for url in readlinks(filename):
+		yield COMMUNITY_ID, url
+
+def readlinks(filename):
+	# Links are read as they are needed instead of all at once, from plain or gzip compressed files
+	opener = gzip.open if filename.endswith(".gz") else open
+	with opener(filename, "rt") as urlsfile:
+		for line in urlsfile:
+			url = line.strip()
+			# Each worker process only takes its share, always the same one for the same post
+			if url and (SHARD is None or zlib.crc32(postname(url).encode()) % WORKERS == SHARD):
+				yield url
+
+def coordinate():
+	# Start a worker process for each share of the links and gather the progress of all of them
+	arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--workers=")]
+	JOURNAL.clearclaims()
+	with open("migration.log", "a") as logfile:
+		workers = [
+			subprocess.Popen([sys.executable, sys.argv[0]] + arguments + [f"--shard={shard}/{WORKERS}"], stdin = subprocess.DEVNULL, stdout = logfile, stderr = logfile)
+			for shard in range(WORKERS)
+		]
+		position = 0
+		while True:
+			finished = all(worker.poll() is not None for worker in workers)
+			position = gathershards(position)
+			if finished:
+				break
+			time.sleep(1)
+	for shard, worker in enumerate(workers):
+		if worker.returncode:
+			log("Failed. op: 'Running worker process', shard: '" + str(shard) + "', response: 'Exited with code " + str(worker.returncode) + ", see migration.log'", "error")
+	if METRICS_FILE:
+		METRICS.writesnapshot(METRICS_FILE)
+
+def gathershards(position):
+	# Metrics of all the workers are added together, and what they logged since last time shown as ours
+	snapshots = []
+	for shard in range(WORKERS):
+		try:
+			with open((METRICS_FILE or "metrics.json") + ".shard" + str(shard), "r") as infile:
+				snapshots.append(json.load(infile))
+		except (FileNotFoundError, json.decoder.JSONDecodeError):
+			pass
+	METRICS.load(snapshots)
+	with open("migration.log", "rb") as logfile:
+		logfile.seek(position)
+		for line in logfile:
+			# Partial lines are read again next time
+			if not line.endswith(b"\n"):
+				break
+			position += len(line)
+			match = re.match(r"(INFO|WARNING|ERROR):__main__:(.*)", line.decode("utf-8", errors = "replace"))
+			if match and match.group(2).strip():
+				RECENT_LOG.append(match.group(2).strip())
+	return position
 
 def main():
-	# Do the migration of the posts asynchronously
-	for url in urls:
-		# NOTICE: Limit posting threads to not overload the instance
-		while (len(threading.enumerate())) > MAXTHREADS:
-			time.sleep(5)
-		if not DEBUGMODE and THREADING:
-			thread = threading.Thread(target = migratepost, args=(url, COMMUNITY_ID), kwargs={})
-			thread.start()
+	if DEBUGMODE or not THREADING:
+		for COMMUNITY_ID, url in schedule():
+			try:
+				migratepost(url, COMMUNITY_ID)
+			except Exception as e:
+				# Never let an unexpected failure stop the migration, just count it and move on
+				log("Failed. op: 'Migrating post', url: '" + url + "', response: '" + repr(e), "error")
+				updatecounter('failed_posts')
+		finish()
+		return
+
+	# Posts go through two stages joined by a bounded queue. Fetch workers download everything from the origin as fast as it allows
+	# and publish workers create it on Lemmy at the rate of the instance, so neither of them sits idle waiting for the other.
+	# NOTICE: Workers pick the next url as soon as they are free, the amount of them is still limited to not overload the instance
+	fetchqueue = queue.Queue(maxsize = FETCHTHREADS * 2)
+	publishqueue = queue.Queue(maxsize = PREFETCH_QUEUE)
+	fetchers = [threading.Thread(target = fetchworker, args=(fetchqueue, publishqueue if MODE == "both" else None), kwargs={}) for _ in range(FETCHTHREADS if MODE != "publish" else 0)]
+	publishers = [threading.Thread(target = publishworker, args=(publishqueue,), kwargs={}) for _ in range(CONCURRENCY.maximum if MODE != "fetch" else 0)]
+	for worker in fetchers + publishers:
+		worker.start()
+	for COMMUNITY_ID, url in schedule():
+		# When only publishing the records are read from the journal
+		if fetchers:
+			fetchqueue.put((COMMUNITY_ID, url))
 		else:
-			migratepost(url, COMMUNITY_ID)
+			publishqueue.put((COMMUNITY_ID, url, None))
+	# One stop signal for each worker once every url went through the previous stage
+	for worker in fetchers:
+		fetchqueue.put(None)
+	for worker in fetchers:
+		worker.join()
+	for worker in publishers:
+		publishqueue.put(None)
+	for worker in publishers:
+		worker.join()
+	finish()
+
+def finish():
+	COMMENT_POOL.shutdown()
+	MEDIA_POOL.shutdown()
+	# Imported communities get their counts and comment times fixed once everything is in
+	if DATABASE:
+		for COMMUNITY_ID in set(COMMUNITY_IDS.values()):
+			try:
+				DATABASE.refresh(COMMUNITY_ID)
+			except psycopg2.Error as e:
+				log("Failed. op: 'Refreshing aggregates', COMMUNITY_ID: '" + str(COMMUNITY_ID) + "', response: '" + repr(e), "error")
+	if METRICS_FILE:
+		METRICS.writesnapshot(METRICS_FILE)
+
+def fetchworker(fetchqueue, publishqueue):
+	while True:
+		item = fetchqueue.get()
+		if item is None:
+			return
+		COMMUNITY_ID, url = item
+		try:
+			# Don't even download what was fully migrated before
+			if publishqueue and migrated(url, COMMUNITY_ID):
+				continue
+			with METRICS.timed("fetch_post"):
+				record = fetchpost(url)
+			if record and publishqueue:
+				publishqueue.put((COMMUNITY_ID, url, record))
+		except Exception as e:
+			# Never let an unexpected failure kill the worker, just count it and move on
+			log("Failed. op: 'Downloading post', url: '" + url + "', response: '" + repr(e), "error")
+			updatecounter('failed_posts')
+
+def publishworker(publishqueue):
+	while True:
+		item = publishqueue.get()
+		if item is None:
+			return
+		COMMUNITY_ID, url, record = item
+		try:
+			with CONCURRENCY.slot(), METRICS.timed("publish_post"):
+				publishpost(url, record, COMMUNITY_ID)
+		except Exception as e:
+			# Never let an unexpected failure kill the worker, just count it and move on
+			log("Failed. op: 'Migrating post', url: '" + url + "', response: '" + repr(e), "error")
+			updatecounter('failed_posts')
 
 def migratepost(url, COMMUNITY_ID):
-	url = url + ".json"
+	# Both stages one after the other, for when there's no threading
+	if MODE == "publish":
+		publishpost(url, None, COMMUNITY_ID)
+	elif MODE == "fetch":
+		fetchpost(url)
+	elif not migrated(url, COMMUNITY_ID):
+		record = fetchpost(url)
+		if record:
+			publishpost(url, record, COMMUNITY_ID)
+
+def migrated(url, COMMUNITY_ID):
+	# Check if a previous run already got this post fully migrated
+	progress = JOURNAL.getpost(COMMUNITY_ID, url)
+	if progress and progress["state"] == "completed":
+		log("Skipping already migrated. op: 'Migrating post', url: '" + url + "'", "info")
+		updatecounter('skipped_posts')
+		return True
+	return False
+
+def fetchpost(link):
+	# The same link can be in several migrations, download it only once
+	with claim(link):
+		# Downloaded before, either by a fetch run, an interrupted migration, for another community or through another crosspost
+		return prefetched(link) or downloadpost(link)
+
+def prefetched(link):
+	# Records are stored under the origin post they resolved to, journals from before that under the link
+	name = JOURNAL.getcanonical(link)
+	return JOURNAL.getprefetch(name) if name else JOURNAL.getprefetch(link)
+
+def downloadpost(link):
+	url = link + ".json"
 
 	# Obtain the content of the post
 	try:
-		response = requests.get(url = url, headers = ORIGINHEADERS)
+		response = originget(url, "origin_post")
 		page = response.json()
 		# Actually the post data is deeper in
 		postdata = page[0]["data"]["children"][0]["data"]
+	except requests.exceptions.RequestException as e:
+		log("Failed. op: 'Downloading post', url: '" + url + "', response: '" + repr(e), "error")
+		updatecounter('failed_posts')
+		return None
 	except:
 		log("Unexpected data. op: 'Downloading post', url: '" + url + "', response: '" + response.text, "error")
 		updatecounter('failed_posts')
-		return
+		return None
 
 	# If the page is a crosspost follow the link and try again
 	try:
@@ -126,16 +1112,212 @@ def migratepost(url, COMMUNITY_ID):
 				break
 			else:
 				redirect = postdata["url"]
+			# Another crosspost of the same parent already got it downloaded
+			record = JOURNAL.getprefetch(postdata["crosspost_parent"])
+			if record:
+				JOURNAL.setcanonical(link, postdata["crosspost_parent"])
+				return record
 			# Overwrite data we are using before testing again
-			url = "https://www.reddit.com" + redirect  + ".json?limit=1000"
-			response = requests.get(url = url, headers = ORIGINHEADERS)
+			url = ORIGINHOST + redirect  + ".json?limit=1000"
+			response = originget(url, "origin_post")
 			page = response.json()
 			postdata = page[0]["data"]["children"][0]["data"]
+	except requests.exceptions.RequestException as e:
+		log("Failed. op: 'Recursing crosspost', url: '" + url + "', response: '" + repr(e), "error")
+		updatecounter('failed_posts')
+		return None
 	except:
 		log("Unexpected data. op: 'Recursing crosspost', url: '" + url + "', response: '" + response.text, "error")
 		updatecounter('failed_posts')
+		return None
+
+	# Many links can lead to the same post, only the first one to get here downloads its comments
+	with claim(postdata["name"]):
+		record = JOURNAL.getprefetch(postdata["name"])
+		if not record:
+			# Big threads only come with part of the comments, fetch the rest too
+			comments = []
+			if MIGRATE_COMMENTS:
+				comments = page[1]["data"]["children"]
+				fetchcomments(comments, postdata)
+
+			# Store only what we need from it so publishing doesn't depend on the origin anymore
+			record = {
+				"post": {field: postdata.get(field) for field in POST_FIELDS},
+				"comments": compactcomments(comments)
+			}
+			JOURNAL.setprefetch(postdata["name"], record)
+			updatecounter('fetched_posts')
+	JOURNAL.setcanonical(link, postdata["name"])
+	return record
+
+def compactcomments(comments):
+	compact = []
+	# Hidden comments stubs were already expanded by now
+	for comment in [comment["data"] for comment in comments if comment["kind"] != "more"]:
+		data = {field: comment.get(field) for field in COMMENT_FIELDS}
+		data["replies"] = {"data": {"children": compactcomments(comment["replies"]["data"]["children"])}} if comment["replies"] else ""
+		compact.append({"kind": "t1", "data": data})
+	return compact
+
+def publishpost(link, record, COMMUNITY_ID):
+	# Check if a previous run already got this post migrated, fully or partially
+	if migrated(link, COMMUNITY_ID):
+		return
+	progress = JOURNAL.getpost(COMMUNITY_ID, link) or {"state": None, "post_id": None, "media_url": None}
+
+	# When only publishing the posts must have been fetched before
+	record = record or prefetched(link)
+	if not record:
+		log("Failed. op: 'Migrating post', url: '" + link + "', response: 'Not fetched yet'", "error")
+		updatecounter('failed_posts')
 		return
+	postdata = record["post"]
 
+	# The post was created before the program was interrupted, only the comments are pending
+	if progress["post_id"]:
+		POST_ID = progress["post_id"]
+		log("Resuming. op: 'Migrating post', url: '" + link + "', POST_ID: '" + str(POST_ID) + "'", "info")
+		if not DATABASE:
+			continuepost(link, postdata, COMMUNITY_ID, POST_ID)
+	else:
+		# Only one of the links that lead to the same post gets to create it, the rest are duplicates of that one
+		name = JOURNAL.getcanonical(link) or postname(link)
+		with claim((COMMUNITY_ID, name)):
+			DUPLICATE_ID = JOURNAL.getduplicate(COMMUNITY_ID, name, link) or sharedduplicate(link, COMMUNITY_ID, name)
+			if DUPLICATE_ID:
+				publishduplicate(link, postdata, COMMUNITY_ID, DUPLICATE_ID)
+				return
+			POST_ID = None
+			try:
+				POST_ID = createpost(link, postdata, COMMUNITY_ID, progress["media_url"])
+			finally:
+				# Let the links of other worker processes have a go at it, also when creating it raised
+				if not POST_ID and SHARES > 1:
+					JOURNAL.releasepost(COMMUNITY_ID, name)
+		if not POST_ID:
+			return
+
+	# Restore the comments if enabled
+	if MIGRATE_COMMENTS:
+		# Transverse the entire replies section adding everything with their corresponding parent, skipping those we already did
+		if DATABASE:
+			importcomments(record["comments"], POST_ID, JOURNAL.getcomments(POST_ID))
+		else:
+			migratecomments(record["comments"], POST_ID, migrated = JOURNAL.getcomments(POST_ID))
+	JOURNAL.setpost(COMMUNITY_ID, link, "completed")
+
+# Seconds a link waits for another worker process to create the post it leads to
+CLAIM_TIMEOUT = 600
+
+def sharedduplicate(link, COMMUNITY_ID, name):
+	# Worker processes take different links that can still lead to the same post, the first one claiming it on the journal
+	# creates it and the rest wait until it exists to become its duplicates
+	if SHARES == 1:
+		return None
+	waited = 0
+	while JOURNAL.claimpost(COMMUNITY_ID, name, link) != link:
+		DUPLICATE_ID = JOURNAL.getduplicate(COMMUNITY_ID, name, link)
+		if DUPLICATE_ID:
+			return DUPLICATE_ID
+		# Don't wait forever on a process that got stuck, the link is tried again on the next run
+		if waited >= CLAIM_TIMEOUT:
+			raise TimeoutError("Another worker process didn't create " + name + " in " + str(CLAIM_TIMEOUT) + " seconds")
+		time.sleep(1)
+		waited += 1
+	return None
+
+def publishduplicate(link, postdata, COMMUNITY_ID, DUPLICATE_ID):
+	# Either leave it out or create a post linking to the one already migrated, without comments in both cases
+	if DUPLICATES == "link":
+		# Only the link and the credits, the pictures and text stay on the migrated post
+		linked = dict(postdata, is_self = False, url = PROTOCOL + "://" + LEMMYHOST + "/post/" + str(DUPLICATE_ID), selftext = "", gallery_data = None, media_metadata = None)
+		if createpost(link, linked, COMMUNITY_ID):
+			JOURNAL.setpost(COMMUNITY_ID, link, "completed")
+	else:
+		log("Skipping duplicate. op: 'Migrating post', url: '" + link + "', POST_ID: '" + str(DUPLICATE_ID) + "'", "info")
+		updatecounter('skipped_posts')
+		JOURNAL.setpost(COMMUNITY_ID, link, "completed", post_id = DUPLICATE_ID)
+
+def fetchcomments(comments, postdata):
+	# Index every comment by its full name so the ones we fetch can be attached below their parent
+	index = {}
+	stubs = []
+	deep = []
+	orphans = []
+	indexcomments(comments, index, stubs, deep)
+
+	while stubs or deep:
+		# Comments hidden behind "load more" stubs are requested in batches, which can reveal more stubs in turn
+		if stubs:
+			batch, stubs = stubs[:MORECHILDREN_BATCH], stubs[MORECHILDREN_BATCH:]
+			payload = {
+				'api_type': 'json',
+				'link_id': postdata["name"],
+				'children': ",".join(batch),
+				'limit_children': 'false'
+			}
+			try:
+				response = originget(ORIGINHOST + "/api/morechildren.json", "origin_comments", params = payload)
+				things = response.json()["json"]["data"]["things"]
+			except Exception as e:
+				log("Ignoring failure. op: 'Fetching more comments', post: '" + postdata["permalink"] + "', response: '" + repr(e), "warning")
+				continue
+			# Stubs go below their parent too, which often comes in the same batch, so threads that go too deep find it indexed
+			orphans = attachcomments(orphans + things, comments, index, stubs, deep, postdata["name"])
+		# Threads that go too deep continue on the permalink of the last comment shown
+		else:
+			parent = deep.pop()
+			try:
+				response = originget(ORIGINHOST + postdata["permalink"] + parent["id"] + ".json", "origin_comments", params = {'limit': 1000})
+				replies = response.json()[1]["data"]["children"][0]["data"]["replies"]
+			except Exception as e:
+				log("Ignoring failure. op: 'Fetching more comments', post: '" + postdata["permalink"] + "', response: '" + repr(e), "warning")
+				continue
+			parent["replies"] = replies
+			if replies:
+				indexcomments(replies["data"]["children"], index, stubs, deep)
+
+	if orphans:
+		log("Ignoring failure. op: 'Fetching more comments', post: '" + postdata["permalink"] + "', response: 'Parent not found for " + str(len(orphans)) + " comments'", "warning")
+
+def indexcomments(comments, index, stubs, deep):
+	for comment in comments:
+		if comment["kind"] == "more":
+			# Stubs without children mean the thread continues in the permalink of the parent
+			if comment["data"]["children"]:
+				stubs.extend(comment["data"]["children"])
+			elif comment["data"]["parent_id"] in index:
+				deep.append(index[comment["data"]["parent_id"]])
+			continue
+		index[comment["data"]["name"]] = comment["data"]
+		if comment["data"]["replies"]:
+			indexcomments(comment["data"]["replies"]["data"]["children"], index, stubs, deep)
+
+def attachcomments(things, comments, index, stubs, deep, link_id):
+	# Fetched comments come flat, put each one in the replies of its parent. Returns those whose parent we don't have yet
+	while things:
+		orphans = []
+		for thing in things:
+			parent_id = thing["data"]["parent_id"]
+			if parent_id == link_id:
+				comments.append(thing)
+			elif parent_id in index:
+				parent = index[parent_id]
+				if not parent["replies"]:
+					parent["replies"] = {"data": {"children": []}}
+				parent["replies"]["data"]["children"].append(thing)
+			else:
+				orphans.append(thing)
+				continue
+			indexcomments([thing], index, stubs, deep)
+		# Stop once a pass doesn't find any new parent
+		if len(orphans) == len(things):
+			break
+		things = orphans
+	return things
+
+def createpost(url, postdata, COMMUNITY_ID, media_url = None):
 	# Compose the post content and attributes
 	# FIXME: API doesn't allow specifying a timestamp for the post so dates are lost. Would this be even supported?
 	# We could edit the timestamp directly on the db "UPDATE post SET published=timestamp WHERE id=id" but the post might have federated already and break things?
@@ -150,250 +1332,521 @@ def migratepost(url, COMMUNITY_ID):
 		'body': ""
 	}
 
+	# Lemmy would reject titles too long after all the media work, so shorten them beforehand and keep them whole on the body
+	title = None
+	if len(payload["name"]) > TITLE_MAX:
+		title = payload["name"]
+		payload["name"] = title[:TITLE_MAX - 3] + "..."
+
+	# Find every media of the post and transfer all of it at once
+	link, lines, inline, gallery = extractmedia(postdata)
+	transfers = [] if media_url or not link else [link]
+	if MIGRATE_PICTURES:
+		transfers += [inlineurl(newstring) for newstring in inline.values()] + [originurl for originurl, caption in gallery]
+	migrations = transfermany(transfers)
+
 	# Migrate media if asked with a proper link
-	if payload["url"]:
-		# Only expand that site hosted stuff
-		if (MIGRATE_PICTURES and "i.redd.it" in payload["url"]) or (MIGRATE_VIDEOS and "v.redd.it" in payload["url"]):
-			migration = migratemedia(payload["url"])
-			if migration:
-				payload["url"] = migration
-			# If migration of the media failed decide whether to skip this post or keep the old link
-			elif MEDIA_SKIP_ON_FAIL:
-				log("Failed. op: 'Migrating post', url: '" + url + "', response: 'Mandated to skip because migration of " + payload["url"] + " failed'", "error")
-				return
-			else:
-				log("Ignoring failure. op: 'Migrating post', url: '" + url + "', response: 'Mandated to continue despite migration of " + payload["url"] + " failing'", "warning")
+	if link:
+		# Don't upload the media again if we did already in a previous run
+		migration = media_url or migrations[link]
+		if migration:
+			payload["url"] = migration
+			JOURNAL.setpost(COMMUNITY_ID, url, "media", media_url = migration)
+		# If migration of the media failed decide whether to skip this post or keep the old link
+		elif MEDIA_SKIP_ON_FAIL:
+			log("Failed. op: 'Migrating post', url: '" + url + "', response: 'Mandated to skip because migration of " + payload["url"] + " failed'", "error")
+			return False
+		else:
+			log("Ignoring failure. op: 'Migrating post', url: '" + url + "', response: 'Mandated to continue despite migration of " + payload["url"] + " failing'", "warning")
+	# Galleries link to their first picture
+	elif gallery:
+		payload["url"] = migrations.get(gallery[0][0]) or gallery[0][0]
 
 	# If selftest, actually append the rest of the post body now doing some cleanups and migrating inline images
 	credits = (postdata["author"], postdata["created_utc"])
-	result, payload["body"] = preparebody(credits, postdata["selftext"]) if postdata["is_self"] else preparebody(credits, "")
+	result, payload["body"] = preparebody(credits, lines, inline, gallery, migrations, title)
 	# A failed report means we are skipping the post because mediadidn't went through
 	if result == "failed":
 		log("Failed. op: 'Migrating post', url: '" + url + "', response: 'Mandated to skip because migration of inline image failed'", "error")
-		return;
+		return False
 	elif result == "ignore":
 		log("Ignoring failure. op: 'Migrating post', url: '" + url + "', response: 'Mandated to continue despite migration of inline image failing'", "warning")
 
-	# Actually create the post
-	try:
-		response = requests.post(url = BASE_API + "/post", json = payload)
-		POST_ID = response.json()["post_view"]["post"]["id"]
-	except json.decoder.JSONDecodeError:
-		log("Unexpected data. op: 'Migrating post', url: '" + url + "', response: '" + response.text, "error")
-		updatecounter('failed_posts')
-	except KeyError:
-		# If we failed with anything other than rate limit skip this one.
-		if response.json().get("error", "ok") != "rate_limit_error":
+	# Actually create the post, or import it straight into the database
+	if DATABASE:
+		try:
+			with METRICS.timed("database_post"):
+				POST_ID = DATABASE.insertpost(payload, postdata)
+		except psycopg2.Error as e:
+			log("Failed. op: 'Importing post', url: '" + url + "', response: '" + repr(e), "error")
+			updatecounter('failed_posts')
+			return False
+	else:
+		# Bodies too long for Lemmy are split, the rest goes on comments once the post exists
+		parts = splitbody(payload["body"])
+		payload["body"] = parts[0]
+		try:
+			response = lemmypost("post", BASE_API + "/post", "op: 'Migrating post', url: '" + url + "'", json = payload)
+			POST_ID = response.json()["post_view"]["post"]["id"]
+		except json.decoder.JSONDecodeError:
+			log("Unexpected data. op: 'Migrating post', url: '" + url + "', response: '" + response.text, "error")
+			updatecounter('failed_posts')
+			return False
+		except requests.exceptions.RequestException as e:
+			log("Failed. op: 'Migrating post', url: '" + url + "', response: '" + repr(e), "error")
+			updatecounter('failed_posts')
+			return False
+		except:
 			log("Failed. op: 'Migrating post', url: '" + url + "', response: '" + response.text, "error")
 			updatecounter('failed_posts')
-			return
-		# If we are rate limited retry in timeouts of 30 seconds
-		while (response.json().get("error", "ok") == "rate_limit_error"):
-			log("Timed out and waiting 30 seconds. op: 'Migrating post', url: '" + url + "', response: '" + response.text, "warning")
-			time.sleep(30)
-			response = requests.post(url = BASE_API + "/post", json = payload)
-		# We should only be here if we didn't get an error of rate limit anymore
-		POST_ID = response.json()["post_view"]["post"]["id"]
-	except:
-		log("Failed. op: 'Migrating post', url: '" + url + "', response: '" + response.text, "error")
-		updatecounter('failed_posts')
-		return
+			return False
 
 	# If we are here congratz, we successfully migrated a post
 	log("Successful. op: 'Migrating post', url: '" + url, "info")
 	updatecounter('migrated_posts')
+	JOURNAL.setpost(COMMUNITY_ID, url, "posted", post_id = POST_ID)
+	# The rest of the body is sent before the post can be marked completed, an interruption meanwhile resumes it
+	if not DATABASE and parts[1:]:
+		continuebody(POST_ID, None, parts[1:], postdata["name"])
+	return POST_ID
 
-	# Get the base list of comments and restore them if enabled
-	if MIGRATE_COMMENTS:
-		comments = page[1]["data"]["children"]
-		# Transverse the entire replies section adding everything with their corresponding parent
-		migratecomments(comments, BASE_API, AUTH, POST_ID)
-
-def migratecomments(comments, BASE_API, AUTH, POST_ID, PARENT_ID = None):
-	# Loop through each child comment
-	for comment in [comment["data"] for comment in comments if comment["kind"] != "more"]:
-		# Compose the comment content and attributes
-		try:
-			payload = {
-				'auth': AUTH,
-				'post_id': POST_ID,
-				'content': "",
-				"parent_id": PARENT_ID
-			}
-			result, payload['content'] = preparebody((comment["author"], comment["created_utc"]), comment["body"])
-		# If we failed to parse this comment simply move on
-		except:
-			log("Failed. op: 'Parsing comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', comment: '" + str(comment), "error")
-			updatecounter('failed_comments')
-			continue
+def continuepost(url, postdata, COMMUNITY_ID, POST_ID):
+	# A resumed post might have been interrupted while sending the rest of a body too long, so compose it again and send the missing parts
+	name = JOURNAL.getcanonical(url) or postname(url)
+	# Posts linking to a duplicate have no body of their own
+	if JOURNAL.isduplicate(COMMUNITY_ID, name, url):
+		return
+	title = postdata["title"] if len(postdata["title"]) > TITLE_MAX else None
+	link, lines, inline, gallery = extractmedia(postdata)
+	transfers = [inlineurl(newstring) for newstring in inline.values()] + [originurl for originurl, caption in gallery] if MIGRATE_PICTURES else []
+	result, body = preparebody((postdata["author"], postdata["created_utc"]), lines, inline, gallery, transfermany(transfers), title)
+	parts = splitbody(body)
+	if parts[1:]:
+		continuebody(POST_ID, None, parts[1:], postdata["name"])
 
-		# Actually create the comment and retrieve de post id
-		try:
-			response = requests.post(url = BASE_API + "/comment", json = payload)
-			COMMENT_ID = response.json()["comment_view"]["comment"]["id"]
-		# Received an invalid response that doesn't parse as Json'
-		except json.decoder.JSONDecodeError:
-			log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + response.text + "', payload: " + str(payload), "error")
-			updatecounter('failed_comments')
+def importcomments(comments, POST_ID, migrated):
+	# The whole tree goes into the database at once, parents first, composing every comment beforehand
+	rows = []
+	pending = collections.deque((comment, None) for comment in comments)
+	while pending:
+		comment, parent_id = pending.popleft()
+		if comment["kind"] == "more":
 			continue
-		except KeyError:
-			# If we failed with anything other than rate limit skip this one.
-			if response.json().get("error", "ok") != "rate_limit_error":
-				log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + response.text + "', payload: " + str(payload), "error")
+		comment = comment["data"]
+		if comment["id"] not in migrated:
+			try:
+				result, content = preparetext((comment["author"], comment["created_utc"]), comment["body"])
+			# If we failed to parse this comment simply move on, its replies can't go without it
+			except:
+				log("Failed. op: 'Parsing comment', POST_ID: '" + str(POST_ID) + "', comment: '" + str(comment), "error")
 				updatecounter('failed_comments')
 				continue
-			# If we are rate limited retry in timeouts of 30 seconds
-			while (response.json().get("error", "ok") == "rate_limit_error"):
-				log("Timed out on POST request to Lemmy. Waiting 30 seconds before retry.")
-				log("Timed out and waiting 30 seconds. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', payload: " + str(payload), "warning")
-				time.sleep(30)
-				try:
-					response = requests.post(url = BASE_API + "/comment", json = payload)
-					COMMENT_ID = response.json()["comment_view"]["comment"]["id"]
-				# If we failed without rate limit again we break this loop and stop trying
-				except KeyError:
-					if response.json().get("error", "ok") != "rate_limit_error":
-						log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + response.text + "', payload: " + str(payload), "error")
-						updatecounter('failed_comments')
-						break
-				except:
-					log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + response.text + "', payload: " + str(payload), "error")
-					updatecounter('failed_comments')
-					break
-		except:
-			log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + response.text + "', payload: " + str(payload), "error")
-			updatecounter('failed_comments')
+			rows.append((comment["id"], parent_id, content, comment["created_utc"], comment["score"]))
+		if comment["replies"]:
+			pending.extend((reply, comment["id"]) for reply in comment["replies"]["data"]["children"])
+	if not rows:
+		return
+
+	try:
+		with METRICS.timed("database_comments"):
+			ids = DATABASE.insertcomments(POST_ID, rows, migrated)
+	except psycopg2.Error as e:
+		log("Failed. op: 'Importing comments', POST_ID: '" + str(POST_ID) + "', response: '" + repr(e), "error")
+		updatecounter('failed_comments', len(rows))
+		return
+	JOURNAL.setcomments(POST_ID, ids.items())
+	updatecounter('migrated_comments', len(rows))
+
+def migratecomments(comments, POST_ID, PARENT_ID = None, migrated = None):
+	# Every comment whose parent already exists in Lemmy is ready to be created, so they are all handed to the shared
+	# comment workers at once and each of them queues its own replies as soon as it gets a COMMENT_ID.
+	pending = set(submitcomments(comments, POST_ID, PARENT_ID, migrated or {}))
+	# Wait until the whole tree is done, collecting the replies queued by the finished comments
+	while pending:
+		done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+		for future in done:
+			pending.update(future.result() or [])
+
+def submitcomments(comments, POST_ID, PARENT_ID, migrated):
+	return [COMMENT_POOL.submit(migratecomment, comment["data"], POST_ID, PARENT_ID, migrated) for comment in comments if comment["kind"] != "more"]
+
+def migratecomment(comment, POST_ID, PARENT_ID, migrated):
+	try:
+		# Already migrated by a previous run, simply continue with its replies
+		if comment["id"] in migrated:
+			COMMENT_ID = migrated[comment["id"]]
+			# It might have been interrupted while sending the rest of a body too long, compose it again to find out
+			rest = splitbody(preparetext((comment["author"], comment["created_utc"]), comment["body"])[1])[1:]
+		else:
+			COMMENT_ID, rest = createcomment(comment, POST_ID, PARENT_ID)
+			if not COMMENT_ID:
+				return []
+	except Exception as e:
+		log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + repr(e), "error")
+		updatecounter('failed_comments')
+		return []
+
+	# Queue the replies now that their parent exists, and the rest of its body so the post waits for it too
+	pending = [COMMENT_POOL.submit(continuebody, POST_ID, COMMENT_ID, rest, comment["id"])] if rest else []
+	if comment["replies"]:
+		pending += submitcomments(comment["replies"]["data"]["children"], POST_ID, COMMENT_ID, migrated)
+	return pending
+
+def createcomment(comment, POST_ID, PARENT_ID):
+	# Compose the comment content and attributes
+	try:
+		payload = {
+			'auth': AUTH,
+			'post_id': POST_ID,
+			'content': "",
+			"parent_id": PARENT_ID
+		}
+		result, payload['content'] = preparetext((comment["author"], comment["created_utc"]), comment["body"])
+		parts = splitbody(payload['content'])
+		payload['content'] = parts[0]
+	# If we failed to parse this comment simply move on
+	except:
+		log("Failed. op: 'Parsing comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', comment: '" + str(comment), "error")
+		updatecounter('failed_comments')
+		return None, []
+
+	# Actually create the comment and retrieve de post id
+	try:
+		response = lemmypost("comment", BASE_API + "/comment", "op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "'", json = payload)
+		COMMENT_ID = response.json()["comment_view"]["comment"]["id"]
+	except requests.exceptions.RequestException as e:
+		log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + repr(e) + "', payload: " + str(payload), "error")
+		updatecounter('failed_comments')
+		return None, []
+	# Received an invalid response that doesn't parse as Json or doesn't contain the comment
+	except:
+		log("Failed. op: 'Migrating comment', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + response.text + "', payload: " + str(payload), "error")
+		updatecounter('failed_comments')
+		return None, []
+
+	# If we arrived here it means the comment succesfully migrated
+	updatecounter('migrated_comments')
+	JOURNAL.setcomment(POST_ID, comment["id"], COMMENT_ID)
+	# The rest of a body too long is left for the caller to send
+	return COMMENT_ID, parts[1:]
+
+def splitbody(text):
+	# Lemmy rejects bodies too long, so they are cut at paragraphs, otherwise at lines or as a last resort anywhere.
+	# Breaks too early in the part, like right after the credits, would waste most of it so they don't count
+	if len(text) <= BODY_MAX:
+		return [text]
+	limit = BODY_MAX - len(CONTINUED)
+	parts = []
+	while len(text) > limit:
+		cut = text.rfind("\n\n", limit // 2, limit)
+		if cut < 0:
+			cut = text.rfind("\n", limit // 2, limit)
+		if cut < 0:
+			cut = limit
+		parts.append(text[:cut])
+		text = text[cut:].lstrip("\n")
+	if text:
+		parts.append(text)
+	# Every part after the first says it continues the previous one
+	return parts[:1] + [CONTINUED + part for part in parts[1:]]
+
+def continuebody(POST_ID, PARENT_ID, parts, origin_id):
+	# The rest of a body too long goes on a chain of comments, each one replying to the previous part. They are kept on the journal as parts of the original id
+	migrated = JOURNAL.getcomments(POST_ID)
+	for number, part in enumerate(parts, 1):
+		part_id = origin_id + "+" + str(number)
+		if part_id in migrated:
+			PARENT_ID = migrated[part_id]
 			continue
+		payload = {
+			'auth': AUTH,
+			'post_id': POST_ID,
+			'content': part,
+			"parent_id": PARENT_ID
+		}
+		try:
+			response = lemmypost("comment", BASE_API + "/comment", "op: 'Continuing body', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "'", json = payload)
+			PARENT_ID = response.json()["comment_view"]["comment"]["id"]
+		except Exception as e:
+			log("Failed. op: 'Continuing body', POST_ID: '" + str(POST_ID) + "', PARENT_ID: '" + str(PARENT_ID) + "', response: '" + repr(e), "error")
+			updatecounter('failed_comments')
+			return
+		JOURNAL.setcomment(POST_ID, part_id, PARENT_ID)
 
-		# If we arrived here it means the comment succesfully migrated
-		updatecounter('migrated_comments')
+def extractmedia(postdata):
+	# Every media of the post found in a single pass: the link of the post, the previews inline in its text and the pictures of galleries
+	link = None if postdata["is_self"] else postdata["url"]
+	# Only expand that site hosted stuff
+	if link and not ((MIGRATE_PICTURES and "i.redd.it" in link) or (MIGRATE_VIDEOS and "v.redd.it" in link)):
+		link = None
 
-		# Recurse again if the comment has more children replies
-		if comment["replies"]:
-			# NOTICE: DO NOT ENABLE THREADING FOR COMMENTS YOU MIGHT CRASH YOUR INSTANCE
-			# thread = threading.Thread(target = migratecomments, args=(comment["replies"]["data"]["children"], BASE_API, AUTH, POST_ID, COMMENT_ID), kwargs={})
-			# thread.start()
-			migratecomments(comment["replies"]["data"]["children"], BASE_API, AUTH, POST_ID, COMMENT_ID)
+	lines, inline = extractinline(postdata["selftext"] if postdata["is_self"] else "")
+
+	# Galleries come with the order of the pictures and the address of each of them separately
+	gallery = []
+	if postdata.get("gallery_data") and postdata.get("media_metadata"):
+		for item in postdata["gallery_data"]["items"]:
+			source = postdata["media_metadata"].get(item["media_id"], {}).get("s", {})
+			originurl = source.get("u") or source.get("gif")
+			if originurl:
+				gallery.append((html.unescape(originurl), item.get("caption") or "Image"))
+	return link, lines, inline, gallery
+
+def extractinline(text):
+	# First escape the content received and get the lines that have image previews
+	lines = html.unescape(text).split("\n") if text else []
+	inline = {}
+	for index, line in enumerate(lines):
+		if "preview.redd.it" in line:
+			# If the url starts with [ simply add the !
+			if line[0] == "[":
+				inline[index] = "!" + line
+			# If we only have the url add a basic text
+			elif line[0:4] == "http":
+				inline[index] = "![Image](" + line + ")"
+	return lines, inline
+
+def preparetext(credits, text):
+	# Bodies that can only have pictures inline, like those of comments
+	lines, inline = extractinline(text)
+	migrations = transfermany([inlineurl(newstring) for newstring in inline.values()] if MIGRATE_PICTURES else [])
+	return preparebody(credits, lines, inline, [], migrations)
+
+def inlineurl(newstring):
+	return newstring.split("(")[1].rstrip(")")
 
-def preparebody(credits, content):
+def transfermany(originurls):
+	# Transfers run at the same time on the media workers, no more than MEDIA_PER_POST of them for the same post
+	migrations = {}
+	pending = {}
+	for originurl in dict.fromkeys(originurls):
+		if len(pending) >= MEDIA_PER_POST:
+			done, _ = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				migrations[pending.pop(future)] = future.result()
+		pending[MEDIA_POOL.submit(migratemedia, originurl)] = originurl
+	for future in concurrent.futures.as_completed(pending):
+		migrations[pending[future]] = future.result()
+	return migrations
+
+def preparebody(credits, lines, inline, gallery, migrations, title = None):
 	# Always give credits to the original poster and jump line
 	credits = ">*originally posted by /u/" + credits[0] + " on " + str(datetime.datetime.fromtimestamp(credits[1])) + "*\n\n"
 
 	# To know how preparation went
 	status = "correct"
 
-	# First escape the content received
-	content = html.unescape(content)
-
-	# Get the list indexes that have image previews
-	lines = content.split("\n")
-	matching = [lines.index(word) for word in lines if "preview.redd.it" in word]
-
-	for index in matching:
-		# If the url starts with [ simply add the !
-		if lines[index][0] == "[":
-			newstring = "!" + lines[index]
-		# If we only have the url add a basic text
-		elif lines[index][0:4] == "http":
-			newstring = "![Image](" + lines[index] + ")"
-
+	# Pictures of galleries go first, then the text with the previews swapped for their migration
+	pictures = []
+	for originurl, caption in gallery:
+		migration = migrations.get(originurl)
+		# If migration of the media failed decide whether to skip this post or keep the old link
+		if MIGRATE_PICTURES and not migration:
+			if MEDIA_SKIP_ON_FAIL:
+				return "failed", ""
+			status = "ignore"
+		pictures.append("![" + caption + "](" + (migration or originurl) + ")")
+	for index, newstring in inline.items():
 		# If we set the script to replace image links, do so
-		if MIGRATE_PICTURES and newstring:
-			# Download original url
-			originurl = newstring.split("(")[1].rstrip(")")
-			migration = migratemedia(originurl)
+		if MIGRATE_PICTURES:
+			migration = migrations.get(inlineurl(newstring))
 			if migration:
-				newstring = newstring if not migration else ("![Image](" + migration + ")")
-			# If migration of the media failed decide whether to skip this post or keep the old link
+				newstring = "![Image](" + migration + ")"
 			elif MEDIA_SKIP_ON_FAIL:
 				return "failed", ""
 			else:
 				status = "ignore"
-
 		# Replace the original line with this.
-		content = content.replace(lines[index], newstring)
-
-	body = status, credits + content
+		lines[index] = newstring
+	# Titles too long to be one go first in full
+	heading = ["**" + title + "**"] if title else []
+	content = "\n\n".join(heading + pictures + (["\n".join(lines)] if lines else []))
 
-	# FIXME: Body cannot be longer than 10.000k characters, alternate solution to not lose data?
-	return body[0:9999]
+	# Bodies longer than Lemmy takes are split afterwards by splitbody
+	return status, credits + content
 
 def migratemedia(originurl):
+	# Only one thread transfers the same url at a time, the others wait and then find it already uploaded
+	with claim(originurl):
+		cached = JOURNAL.getmedia(originurl)
+		if cached and cached["new_url"]:
+			log("Reusing already uploaded. op: 'Migrating media', url: '" + originurl + "', response: '" + cached["new_url"] + "'", "info")
+			updatecounter('cached_media')
+			return cached["new_url"]
+		return transfermedia(originurl, cached["hash"] if cached else None)
+
+def transfermedia(originurl, digest = None):
+	filename = None
+	media = None
+	streamed = []
 	try:
-		# Store videos temporarily
-		if ("v.redd.it" in originurl):
+		# Media downloaded on a previous attempt might still be on the local cache
+		media = MEDIA_CACHE.read(digest)
+		if media:
+			pass
+		# Videos need to be muxed by yt-dlp so they always go through a temporary file
+		elif ("v.redd.it" in originurl):
 			# Disable audio
-			filename = "temp/" + originurl.replace("/","") + ".mp4"
+			filename = os.path.join(MEDIA_TEMP_DIR, originurl.replace("/","") + ".mp4")
 			yt_opts = {
 				'outtmpl': filename,
 				'quiet': True,
-				'noprogress': True
+				'noprogress': True,
+				'max_filesize': MEDIA_MAX_BYTES
 			}
-			with yt_dlp.YoutubeDL(yt_opts) as ydl:
+			with ORIGIN_SLOTS, METRICS.timed("ytdlp"), yt_dlp.YoutubeDL(yt_opts) as ydl:
 				ydl.download([originurl])
-			media = {'images[]': open(filename,'rb')}
+			METRICS.increment("downloaded_bytes", os.path.getsize(filename))
+			if os.path.getsize(filename) > MEDIA_MAX_BYTES:
+				raise ValueError("Media bigger than the maximum allowed size")
+			transcoded = transcodevideo(originurl, filename)
+			if transcoded != filename:
+				os.remove(filename)
+				filename = transcoded
+			media = open(filename,'rb')
 		elif any(substring in originurl for substring in ["i.redd.it", "preview.redd.it"]):
-			response = requests.get(originurl)
-			media = {'images[]': io.BytesIO(response.content)}
+			# Pipe pictures straight from the origin into the upload, hashing them on the way
+			if STREAM_IMAGES:
+				def opener():
+					streamed.append(hashlib.sha256())
+					return downloadchunks(originurl, streamed[-1])
+				upload = MultipartUpload(opener)
+			# Or keep them in memory, moving to disk the ones too big for it
+			else:
+				media = tempfile.SpooledTemporaryFile(max_size = SPOOL_MAX_BYTES, dir = MEDIA_TEMP_DIR)
+				for chunk in downloadchunks(originurl, hashlib.sha256()):
+					media.write(chunk)
+		else:
+			raise ValueError("Unsupported media host")
+		if media:
+			digest = hashmedia(media)
 	except:
 		# FIXME: Proper error reporting from yt-dlp?
 		log("Failed. op: 'Downloading media', url: '" + originurl + "'", "error")
 		updatecounter('failed_media')
+		closemedia(media, filename)
 		return False
-	else:
+
+	try:
+		if media:
+			# The very same file might have been uploaded before from a different url
+			newurl = JOURNAL.getmediahash(digest)
+			if newurl:
+				log("Reusing already uploaded. op: 'Migrating media', url: '" + originurl + "', response: '" + newurl + "'", "info")
+				JOURNAL.setmedia(originurl, digest, newurl)
+				updatecounter('cached_media')
+				return newurl
+
+			# Keep a local copy so a failed upload doesn't need to download it again
+			MEDIA_CACHE.write(digest, media)
+			JOURNAL.setmedia(originurl, digest)
+			media.seek(0, os.SEEK_END)
+			upload = MultipartUpload(lambda: filechunks(media), media.tell())
+
 		# For uploading the picture we need an AUTH
 		cookies = {
 			'jwt': AUTH
 		}
+		response = None
 		try:
-			response = requests.post(url = PROTOCOL + "://" + LEMMYHOST + "/pictrs/image", cookies = cookies, files = media)
-			newurl = PROTOCOL + "://" + LEMMYHOST + "/pictrs/image/" + response.json()["files"][0]["file"]
-		except json.decoder.JSONDecodeError:
-			log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + response.text, "error")
+			response = lemmypost("image", PICTRS_API, "op: 'Migrating media', url: '" + originurl + "'", cookies = cookies, data = upload, headers = {'Content-Type': upload.content_type})
+			newurl = PICTRS_API + "/" + response.json()["files"][0]["file"]
+		except requests.exceptions.RequestException as e:
+			log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + repr(e), "error")
 			updatecounter('failed_media')
 			return False
-		except KeyError:
-			# If we failed with anything other than rate limit skip this one.
-			if response.json().get("error", "ok") != "rate_limit_error":
-				log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + response.text, "error")
-				updatecounter('failed_media')
-				return False
-			# If we are rate limited retry in timeouts of 30 seconds
-			while (response.json().get("error", "ok") == "rate_limit_error"):
-				log("Timed out and waiting 30 seconds. op: 'Migrating media', url: '" + originurl + "', response: '" + response.text, "warning")
-				time.sleep(30)
-				try:
-					response = requests.post(url = PROTOCOL + "://" + LEMMYHOST + "/pictrs/image", cookies = cookies, files = media)
-					newurl = PROTOCOL + "://" + LEMMYHOST + "/pictrs/image/" + response.json()["files"][0]["file"]
-				# If we failed without rate limit again we break this loop and stop trying
-				except KeyError:
-					if response.json().get("error", "ok") != "rate_limit_error":
-						log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + response.text, "error")
-						interfacevars['failed_media'] += 1
-						return False
-				except:
-					log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + response.text, "error")
-					interfacevars['failed_media'] += 1
-					return False
-		except:
-			log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + response.text, "error")
+		except Exception as e:
+			log("Failed. op: 'Migrating media', url: '" + originurl + "', response: '" + (response.text if response is not None else repr(e)), "error")
 			updatecounter('failed_media')
-			return
+			return False
 		else:
 			updatecounter('migrated_media')
-			# Delete temporal video from filesystem
-			if "v.redd.it" in originurl:
-				if os.path.exists(filename):
-					os.remove(filename)
+			# Streamed pictures only know their hash once they went through completely
+			if streamed:
+				digest = streamed[-1].hexdigest()
+			JOURNAL.setmedia(originurl, digest, newurl)
 			return newurl
+		finally:
+			upload.close()
+	finally:
+		# Delete temporal video from filesystem
+		closemedia(media, filename)
+
+def transcodevideo(originurl, filename):
+	# Smaller videos get through pictrs before Lemmy stops waiting for it. Returns the file to upload, the same one if it wasn't converted
+	if not TRANSCODE or os.path.getsize(filename) <= TRANSCODE_ABOVE_BYTES:
+		return filename
+	transcoded = filename[:-4] + ".transcoded.mp4"
+	command = [
+		TRANSCODE_FFMPEG, "-y", "-loglevel", "error", "-i", filename,
+		# Only ever scale down, keeping the aspect ratio and even dimensions
+		"-vf", f"scale=-2:'min({TRANSCODE_MAX_HEIGHT},trunc(ih/2)*2)'",
+		"-c:v", "libx264", "-preset", TRANSCODE_PRESET, "-crf", "28", "-maxrate", f"{TRANSCODE_VIDEO_KBPS}k", "-bufsize", f"{TRANSCODE_VIDEO_KBPS * 2}k",
+		"-c:a", "aac", "-b:a", f"{TRANSCODE_AUDIO_KBPS}k", "-movflags", "+faststart",
+		transcoded
+	]
+	# Encoding happens on its own processes, the media worker only waits for them
+	try:
+		with TRANSCODE_SLOTS, METRICS.timed("transcode"):
+			subprocess.run(command, check = True, capture_output = True)
+	except (OSError, subprocess.CalledProcessError) as e:
+		response = e.stderr.decode(errors = "replace").strip() if isinstance(e, subprocess.CalledProcessError) else repr(e)
+		log("Ignoring failure. op: 'Transcoding video', url: '" + originurl + "', response: '" + response, "warning")
+		if os.path.exists(transcoded):
+			os.remove(transcoded)
+		return filename
+	# Already small enough videos can come out bigger
+	if os.path.getsize(transcoded) >= os.path.getsize(filename):
+		os.remove(transcoded)
+		return filename
+	METRICS.increment("transcoded_bytes_saved", os.path.getsize(filename) - os.path.getsize(transcoded))
+	return transcoded
+
+def originget(url, stage, **kwargs):
+	# Downloads from the origin respect its concurrency limit and are measured as the given stage
+	with ORIGIN_SLOTS, METRICS.timed(stage):
+		response = ORIGIN_SESSION.get(url = url, timeout = TIMEOUT, **kwargs)
+	METRICS.increment("downloaded_bytes", len(response.content))
+	return response
+
+def downloadchunks(originurl, digest):
+	# Chunks of the media as they arrive from the origin, hashed and checked against the size limit on the way
+	with ORIGIN_SLOTS, METRICS.timed("origin_media"):
+		with ORIGIN_SESSION.get(originurl, timeout = TIMEOUT, stream = True) as response:
+			response.raise_for_status()
+			size = 0
+			for chunk in response.iter_content(CHUNK_SIZE):
+				size += len(chunk)
+				if size > MEDIA_MAX_BYTES:
+					raise ValueError("Media bigger than the maximum allowed size")
+				digest.update(chunk)
+				METRICS.increment("downloaded_bytes", len(chunk))
+				yield chunk
+
+def filechunks(media):
+	media.seek(0)
+	return iter(lambda: media.read(CHUNK_SIZE), b"")
+
+def hashmedia(media):
+	# Content hash of the media, read in chunks so big videos don't need to fit in memory
+	digest = hashlib.sha256()
+	for chunk in filechunks(media):
+		digest.update(chunk)
+	media.seek(0)
+	return digest.hexdigest()
+
+def closemedia(media, filename):
+	if media:
+		media.close()
+	if filename and os.path.exists(filename):
+		os.remove(filename)
 
 def log(message, level):
 	if DEBUGMODE:
 		print(message)
 	else:
-		global interfacevars
-		# Save for curses output, remove all newlines and carriage returns that blow it up beforehand
-		interfacevars['error_output'].append(message.replace("\r\n",""))
+		# Save for curses output, remove all newlines and carriage returns that blow it up beforehand. Appending to the deque needs no lock and drops the oldest message once full
+		RECENT_LOG.append(message.replace("\r\n",""))
 	match level:
 		case "error":
 			logger.error(message + "\n")
@@ -402,80 +1855,113 @@ def log(message, level):
 		case "info":
 			logger.info(message + "\n")
 
-def updatecounter(target):
-	if not DEBUGMODE:
-		global interfacevars
-		interfacevars[target] += 1
-
-def rendercurses():
-	# Clear the screen
-	stdscr.clear()
-
-	# Print the updated values in the first section
-	stdscr.addstr(0, 0, f"Migrating links from {ORIGIN} into community !{COMMUNITY_NAME}@{LEMMYHOST}", curses.color_pair(3))
-	stdscr.hline(1, 0, curses.ACS_HLINE, screen_width)
-	stdscr.addstr(2, 0, f"Posts migrated: {interfacevars['migrated_posts']}", curses.color_pair(1))
-	stdscr.addstr(2, 30, f"Failed posts: {interfacevars['failed_posts']}", curses.color_pair(2))
-	stdscr.addstr(3, 0, f"Media migrated: {interfacevars['migrated_media']}", curses.color_pair(1))
-	stdscr.addstr(3, 30, f"Failed media: {interfacevars['failed_media']}", curses.color_pair(2))
-	stdscr.addstr(4, 0, f"Comments migrated: {interfacevars['migrated_comments']}", curses.color_pair(1))
-	stdscr.addstr(4, 30, f"Failed comments: {interfacevars['failed_comments']}", curses.color_pair(2))
+def updatecounter(target, amount = 1):
+	# Progress counters live along the rest of metrics so every thread updates them under the same lock
+	METRICS.increment(target, amount)
 
+def runtime():
 	# Calculate the days, hours, minutes, and seconds
-	current_time = time.time()
-	elapsed_time = current_time - start_time
-	runtime = datetime.timedelta(seconds=int(elapsed_time))
-	days = runtime.days
-	hours, remainder = divmod(runtime.seconds, 3600)
+	elapsed = datetime.timedelta(seconds = int(time.time() - start_time))
+	hours, remainder = divmod(elapsed.seconds, 3600)
 	minutes, seconds = divmod(remainder, 60)
+	return elapsed.days, hours, minutes, seconds
+
+def statusline():
+	# Everything the curses screen shows on its first section, in a single line
+	counters = {name: METRICS.value(name) for name in ["migrated_posts", "failed_posts", "skipped_posts", "fetched_posts", "migrated_media", "failed_media", "cached_media", "migrated_comments", "failed_comments"]}
+	days, hours, minutes, seconds = runtime()
+	return (f"Posts migrated/failed/skipped/fetched: {counters['migrated_posts']}/{counters['failed_posts']}/{counters['skipped_posts']}/{counters['fetched_posts']} | "
+		f"Media migrated/failed/reused: {counters['migrated_media']}/{counters['failed_media']}/{counters['cached_media']} | "
+		f"Comments migrated/failed: {counters['migrated_comments']}/{counters['failed_comments']} | "
+		f"Posts at once: {METRICS.gauge('posts_limit')} | "
+		f"Runtime: {days}d {hours:02}:{minutes:02}:{seconds:02}")
+
+def drawcurses(row, column, width, text, color):
+	# Only write what changed since the last refresh, padding to the width of the field to clear what was there before
+	text = text[:min(width, screen_width - column)].ljust(min(width, screen_width - column))
+	if drawn.get((row, column)) == (text, color):
+		return
+	try:
+		stdscr.addstr(row, column, text, curses.color_pair(color))
+		drawn[(row, column)] = (text, color)
+	except curses.error:
+		# FIXME: Don't crash if curses fails to print the line, just check the log so see the problem
+		pass
+
+def rendercurses():
+	# Print the updated values in the first section
+	if len(MIGRATIONS) == 1:
+		drawcurses(0, 0, screen_width, f"Migrating links from {MIGRATIONS[0][1]} into community !{MIGRATIONS[0][0]}@{LEMMYHOST}", 3)
+	else:
+		drawcurses(0, 0, screen_width, f"Migrating {len(MIGRATIONS)} files into communities {', '.join(sorted(set('!' + migrationinfo[0] for migrationinfo in MIGRATIONS)))} at {LEMMYHOST}", 3)
+	drawcurses(2, 0, 30, f"Posts migrated: {METRICS.value('migrated_posts')}", 1)
+	drawcurses(2, 30, 30, f"Failed posts: {METRICS.value('failed_posts')}", 2)
+	drawcurses(2, 60, 30, f"Skipped posts: {METRICS.value('skipped_posts')}", 4)
+	drawcurses(3, 0, 30, f"Media migrated: {METRICS.value('migrated_media')}", 1)
+	drawcurses(3, 30, 30, f"Failed media: {METRICS.value('failed_media')}", 2)
+	drawcurses(3, 60, 30, f"Reused media: {METRICS.value('cached_media')}", 4)
+	drawcurses(4, 0, 30, f"Comments migrated: {METRICS.value('migrated_comments')}", 1)
+	drawcurses(4, 30, 30, f"Failed comments: {METRICS.value('failed_comments')}", 2)
+	drawcurses(4, 60, 30, f"Fetched posts: {METRICS.value('fetched_posts')}", 3)
 
 	# Print the current runtime
-	stdscr.addstr(5, 0, f"Runtime: {days} days, {hours} hours, {minutes} minutes, {seconds} seconds.", curses.color_pair(5))
+	days, hours, minutes, seconds = runtime()
+	drawcurses(5, 0, 60, f"Runtime: {days} days, {hours} hours, {minutes} minutes, {seconds} seconds.", 5)
 	# Print the current total threads
-	stdscr.addstr(5, 60, f"Threads: {str(len(threading.enumerate()))}", curses.color_pair(4))
+	drawcurses(5, 60, 30, f"Threads: {str(len(threading.enumerate()))}", 4)
+	drawcurses(5, 90, 30, f"Posts at once: {METRICS.gauge('posts_limit')}", 4)
 
 	# Calculate the height for the second section
 	second_section_height = screen_height - first_section_height
 
 	# Print the updated text in the second section
 	max_rows = second_section_height - 2  # Leave one row for the border
-	text_to_print = interfacevars['error_output'][-max_rows:]  # Get the last portion of the text
+	text_to_print = list(RECENT_LOG.copy())[-max_rows:]  # Get the last portion of the text
+	text_to_print += [""] * (max_rows - len(text_to_print))
 	for i, line in enumerate(text_to_print):
-		try:
-			match line[:6]:
-				case "Succes":
-					stdscr.addstr(i + first_section_height + 1, 0, line[:screen_width], curses.color_pair(1))
-				case "Failed":
-					stdscr.addstr(i + first_section_height + 1, 0, line[:screen_width], curses.color_pair(2))
-				case "Unexpe":
-					stdscr.addstr(i + first_section_height + 1, 0, line[:screen_width], curses.color_pair(2))
-				case "Timed ":
-					stdscr.addstr(i + first_section_height + 1, 0, line[:screen_width], curses.color_pair(4))
-				case "Ignori":
-					stdscr.addstr(i + first_section_height + 1, 0, line[:screen_width], curses.color_pair(4))
-		except:
-			# FIXME: Don't crash if curses fails to print the line, just check the log so see the problem
-			pass
-
-	# Draw a border between the two sections
-	stdscr.hline(first_section_height, 0, curses.ACS_HLINE, screen_width)
+		match line[:6]:
+			case "Succes":
+				color = 1
+			case "Failed" | "Unexpe":
+				color = 2
+			case "Timed " | "Ignori":
+				color = 4
+			case "Skippi" | "Resumi" | "Reusin":
+				color = 3
+			case _:
+				color = 0
+		drawcurses(i + first_section_height + 1, 0, screen_width, line, color)
 
 	# Refresh the screen
 	stdscr.refresh()
 
+# Export the metrics now that a migration is going to run, going on without the endpoint if its port is taken
+if METRICS_PORT:
+	try:
+		METRICS.serve(METRICS_PORT)
+	except OSError as e:
+		log("Ignoring failure. op: 'Serving metrics', port: '" + str(METRICS_PORT) + "', response: '" + repr(e), "warning")
+if METRICS_FILE:
+	METRICS.writesnapshots(METRICS_FILE, METRICS_INTERVAL)
+
 if DEBUGMODE:
 	main()
+elif SHARD is not None:
+	# Worker processes only report through their metrics, the process that started them shows everything
+	main()
+elif INTERFACE == "headless":
+	# Start the migration
+	thread = threading.Thread(target=coordinate if COORDINATOR else main, args=(), kwargs={})
+	thread.start()
+
+	# Print the progress every so often until it finishes
+	while True:
+		thread.join(STATUS_INTERVAL)
+		if not thread.is_alive():
+			break
+		print(statusline(), flush = True)
+	print("Completed migration. " + statusline(), flush = True)
 else:
-	# Curses related variables
-	interfacevars = {
-		"migrated_posts": 0,
-		"failed_posts": 0,
-		"migrated_media": 0,
-		"failed_media": 0,
-		"migrated_comments": 0,
-		"failed_comments": 0,
-		"error_output": []
-	}
 	# Initialize the curses screen
 	stdscr = curses.initscr()
 
@@ -494,14 +1980,20 @@ else:
 	screen_height, screen_width = stdscr.getmaxyx()
 	# Define the height for the first section (4 rows)
 	first_section_height = 6
+	# What is currently on screen, so each refresh only redraws what changed
+	drawn = {}
+
+	# Draw the borders between the sections once
+	stdscr.hline(1, 0, curses.ACS_HLINE, screen_width)
+	stdscr.hline(first_section_height, 0, curses.ACS_HLINE, screen_width)
 
 	# Start the migration
-	thread = threading.Thread(target=main, args=(), kwargs={})
+	thread = threading.Thread(target=coordinate if COORDINATOR else main, args=(), kwargs={})
 	thread.start()
 
 	while True:
-		# If we only have one remaining thread it means we finished and thus can end
-		if (len(threading.enumerate()) == 1):
+		# Once the migration thread is done we finished and thus can end
+		if not thread.is_alive():
 			break
 		rendercurses()
 		# Sleep for 1 second
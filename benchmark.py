@@ -0,0 +1,354 @@
+#!/usr/bin/python
+import argparse
+import hjson
+import http.server
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# Stand-in for a Lemmy instance, its pictrs and the origin site, so the migration can be measured without touching real servers.
+# Run it with the same config.hjson you would use for a real migration, only hosts, rate limits and the journal are replaced.
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "antenna2lemmy.py")
+
+class Stats:
+	# Everything the mock servers saw, shared by all the request handlers
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.ids = itertools.count(1)
+		self.requests = {}
+		self.ratelimited = 0
+		self.media_bytes = 0
+		self.posts = 0
+		self.comments = 0
+		# Posts and comments with bodies longer than Lemmy takes
+		self.rejected = 0
+		# Origin id of the post -> time we were first asked for it, and Lemmy post id -> origin id
+		self.fetched = {}
+		self.created = {}
+		self.origins = {}
+		# Lemmy post id -> time its last comment was created
+		self.lastcomment = {}
+
+	def count(self, endpoint):
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+def buildcomments(postid, amount, branching):
+	# A quarter of the comments are top level and the rest replies, breadth first. About a tenth of the top level ones are hidden behind a "more" stub
+	comments = [{"id": postid + "c" + str(number), "parent": None, "replies": []} for number in range(amount)]
+	toplevel = comments[:max(1, amount // 4)]
+	for number, comment in enumerate(comments[len(toplevel):]):
+		comment["parent"] = comments[number // branching]
+		comment["parent"]["replies"].append(comment)
+	hidden = toplevel[len(toplevel) - len(toplevel) // 10:] if len(toplevel) >= 10 else []
+	return toplevel[:len(toplevel) - len(hidden)], hidden
+
+def redditcomment(comment, link_id, flat = False):
+	data = {
+		"id": comment["id"],
+		"name": "t1_" + comment["id"],
+		"parent_id": "t1_" + comment["parent"]["id"] if comment["parent"] else link_id,
+		"author": "benchmark",
+		"created_utc": 1600000000,
+		"score": 1,
+		"body": "Synthetic comment " + comment["id"] + " with some &amp; escaped text",
+		"replies": ""
+	}
+	if comment["replies"] and not flat:
+		data["replies"] = {"data": {"children": [redditcomment(reply, link_id) for reply in comment["replies"]]}}
+	return {"kind": "t1", "data": data}
+
+def buildhandler(options, stats, origin):
+	media = os.urandom(options.media_kb * 1024)
+	# Every post has the same tree shape, so only build it once
+	toplevel, hidden = buildcomments("", options.comments, options.branching)
+
+	class Handler(http.server.BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def log_message(self, *args):
+			pass
+
+		def send(self, body, content_type = "application/json"):
+			if content_type == "application/json":
+				body = json.dumps(body).encode()
+			self.send_response(200)
+			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def notfound(self):
+			self.send_response(404)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+
+		def readbody(self):
+			if self.headers.get("Transfer-Encoding") == "chunked":
+				body = b""
+				while True:
+					size = int(self.rfile.readline().strip(), 16)
+					if not size:
+						self.rfile.readline()
+						return body
+					body += self.rfile.read(size)
+					self.rfile.readline()
+			return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+		def toolong(self, text):
+			# Lemmy refuses bodies over 10000 characters
+			if text and len(text) > 10000:
+				with stats.lock:
+					stats.rejected += 1
+				self.send({"error": "invalid_body_field"})
+				return True
+			return False
+
+		def ratelimited(self):
+			# Randomly answer like Lemmy does when its rate limits are hit
+			if random.random() < options.ratelimit:
+				with stats.lock:
+					stats.ratelimited += 1
+				self.send({"error": "rate_limit_error"})
+				return True
+			return False
+
+		def do_GET(self):
+			path, _, query = self.path.partition("?")
+			query = urllib.parse.parse_qs(query)
+			if origin:
+				time.sleep(options.origin_latency / 1000)
+				self.originget(path, query)
+			else:
+				time.sleep(options.latency / 1000)
+				stats.count("GET " + path)
+				if path == "/api/v3/community":
+					return self.send({"community_view": {"community": {"id": 1, "name": query["name"][0]}}})
+				self.notfound()
+
+		def originget(self, path, query):
+			if "/i.redd.it/" in path or "/preview.redd.it/" in path:
+				stats.count("GET media")
+				# Different content for each url so the migration can't skip uploads as duplicates
+				return self.send(path.encode() + media, "image/jpeg")
+			if path == "/api/morechildren.json":
+				stats.count("GET morechildren")
+				link_id = query["link_id"][0]
+				postid = link_id[3:]
+				wanted = set(query["children"][0].split(","))
+				things = []
+				for comment in hidden:
+					if postid + comment["id"] in wanted:
+						things += flatten(comment, postid, link_id)
+				return self.send({"json": {"errors": [], "data": {"things": things}}})
+			parts = path.split("/")
+			# /r/benchmark/comments/<id>/post.json
+			if len(parts) == 6 and parts[3] == "comments":
+				stats.count("GET post")
+				postid = parts[4]
+				with stats.lock:
+					stats.fetched.setdefault(postid, time.monotonic())
+				return self.send(originpost(postid))
+			self.notfound()
+
+		def do_POST(self):
+			body = self.readbody()
+			time.sleep((options.pictrs_latency if self.path == "/pictrs/image" else options.latency) / 1000)
+			stats.count("POST " + self.path)
+			if self.path == "/api/v3/user/login":
+				return self.send({"jwt": "benchmark"})
+			if self.path == "/pictrs/image":
+				if self.ratelimited():
+					return
+				with stats.lock:
+					stats.media_bytes += len(body)
+				return self.send({"msg": "ok", "files": [{"file": str(next(stats.ids)) + ".jpg", "delete_token": "x"}]})
+			if self.path == "/api/v3/post":
+				if self.ratelimited():
+					return
+				payload = json.loads(body)
+				if self.toolong(payload["body"]):
+					return
+				postid = next(stats.ids)
+				with stats.lock:
+					stats.posts += 1
+					stats.created[postid] = time.monotonic()
+					# The benchmark titles carry the origin id to match them with their fetch
+					stats.origins[postid] = payload["name"].split()[-1]
+				return self.send({"post_view": {"post": {"id": postid}}})
+			if self.path == "/api/v3/comment":
+				if self.ratelimited():
+					return
+				payload = json.loads(body)
+				if self.toolong(payload["content"]):
+					return
+				with stats.lock:
+					stats.comments += 1
+					stats.lastcomment[payload["post_id"]] = time.monotonic()
+				return self.send({"comment_view": {"comment": {"id": next(stats.ids)}}})
+			self.notfound()
+
+	def flatten(comment, postid, link_id):
+		# morechildren answers with the whole subtree as a flat list
+		renamed = dict(comment, id = postid + comment["id"])
+		things = [redditcomment(renamed, link_id, flat = True)]
+		for reply in comment["replies"]:
+			things += flatten(dict(reply, parent = renamed), postid, link_id)
+		return things
+
+	def renamecomments(comments, postid, parent = None):
+		renamed = []
+		for comment in comments:
+			copy = dict(comment, id = postid + comment["id"], parent = parent)
+			copy["replies"] = renamecomments(comment["replies"], postid, copy)
+			renamed.append(copy)
+		return renamed
+
+	def originpost(postid):
+		host = "http://127.0.0.1:" + str(options.port + 1)
+		link_id = "t3_" + postid
+		# One in four posts is a self post with an inline picture and a single paragraph too long for one body, the rest link a picture
+		selfpost = int(postid) % 4 == 0
+		post = {
+			"id": postid,
+			"name": link_id,
+			"permalink": "/r/benchmark/comments/" + postid + "/post/",
+			"title": "Benchmark post " + postid,
+			"author": "benchmark",
+			"created_utc": 1600000000,
+			"score": 10,
+			"is_self": selfpost,
+			"url": host + "/r/benchmark/comments/" + postid + "/post/" if selfpost else host + "/i.redd.it/" + postid + ".jpg",
+			"url_overridden_by_dest": "",
+			"selftext": "Some text before the picture\n\n" + host + "/preview.redd.it/" + postid + ".jpg?width=640\n\n" + "and some after " * (options.body_kb * 64) if selfpost else ""
+		}
+		comments = [redditcomment(comment, link_id) for comment in renamecomments(toplevel, postid)]
+		if hidden:
+			comments.append({"kind": "more", "data": {"id": postid + "more", "name": "t1_" + postid + "more", "parent_id": link_id, "count": len(hidden), "children": [postid + comment["id"] for comment in hidden]}})
+		return [
+			{"kind": "Listing", "data": {"children": [{"kind": "t3", "data": post}]}},
+			{"kind": "Listing", "data": {"children": comments}}
+		]
+
+	return Handler
+
+def percentile(values, fraction):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def writeconfig(options, workdir):
+	# Same options as the real migration, pointed at the mock servers and without client side rate limits
+	with open(options.config, "r") as infile:
+		config = hjson.loads(infile.read())
+	config["lemmy-conn"]["host"] = "127.0.0.1:" + str(options.port)
+	config["lemmy-conn"]["protocol"] = "http"
+	config["origin-conn"]["host"] = "http://127.0.0.1:" + str(options.port + 1)
+	config["script-options"]["threading"] = True
+	config["interface"]["mode"] = "headless"
+	config["metrics"]["port"] = 0
+	config["metrics"]["snapshot_file"] = ""
+	config["script-options"]["migratecomments"] = options.comments > 0
+	config["script-options"]["journal"] = os.path.join(workdir, "migration.db")
+	config["media-cache"]["directory"] = os.path.join(workdir, "mediacache")
+	config["media-transfer"]["temp_directory"] = os.path.join(workdir, "temp")
+	if options.threads:
+		config["script-options"]["max_threads"] = options.threads
+	for action in ["post", "comment", "image"]:
+		config["rate-limits"][action] = 0
+	config["rate-limits"]["backoff_initial"] = 1
+	with open(os.path.join(workdir, "config.hjson"), "w") as outfile:
+		outfile.write(hjson.dumps(config))
+	with open(os.path.join(workdir, "links.txt"), "w") as outfile:
+		for postid in range(1, options.posts + 1):
+			outfile.write("http://127.0.0.1:" + str(options.port + 1) + "/r/benchmark/comments/" + str(postid) + "/post\n")
+
+def runmigration(workdir):
+	# Without a screen the migration only prints a status line now and then, which isn't needed here
+	environment = dict(os.environ)
+	environment.pop("DEBUGMODE", None)
+	process = subprocess.run([sys.executable, SCRIPT, "benchmark,links.txt"], cwd = workdir, env = environment, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL)
+	return process.returncode
+
+def main():
+	parser = argparse.ArgumentParser(description = "Measure the migration throughput against local mock Lemmy, pictrs and origin servers")
+	parser.add_argument("--config", default = "config.hjson", help = "base configuration, the hosts, rate limits and journal are replaced")
+	parser.add_argument("--posts", type = int, default = 200, help = "amount of posts to migrate")
+	parser.add_argument("--comments", type = int, default = 20, help = "comments on each post, 0 to not migrate comments")
+	parser.add_argument("--branching", type = int, default = 3, help = "replies of each comment in the synthetic threads")
+	parser.add_argument("--media-kb", type = int, default = 256, help = "size of each picture")
+	parser.add_argument("--body-kb", type = int, default = 24, help = "size of the last paragraph of self posts, bigger than 10 to check long bodies are split")
+	parser.add_argument("--latency", type = float, default = 20, help = "milliseconds the Lemmy API takes to answer")
+	parser.add_argument("--pictrs-latency", type = float, default = 50, help = "milliseconds pictrs takes to answer")
+	parser.add_argument("--origin-latency", type = float, default = 50, help = "milliseconds the origin takes to answer")
+	parser.add_argument("--ratelimit", type = float, default = 0, help = "fraction of creation requests answered with rate_limit_error")
+	parser.add_argument("--threads", type = int, default = 0, help = "override max_threads of the configuration")
+	parser.add_argument("--port", type = int, default = 8536, help = "port of the mock Lemmy, the origin listens on the next one")
+	parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+	options = parser.parse_args()
+	options.config = os.path.abspath(options.config)
+
+	stats = Stats()
+	servers = [
+		http.server.ThreadingHTTPServer(("127.0.0.1", options.port), buildhandler(options, stats, False)),
+		http.server.ThreadingHTTPServer(("127.0.0.1", options.port + 1), buildhandler(options, stats, True))
+	]
+	for server in servers:
+		server.daemon_threads = True
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+
+	with tempfile.TemporaryDirectory() as workdir:
+		writeconfig(options, workdir)
+		start = time.monotonic()
+		returncode = runmigration(workdir)
+		elapsed = time.monotonic() - start
+
+	for server in servers:
+		server.shutdown()
+
+	# Post latency goes from its first download to its creation, thread latency from the post to its last comment
+	postlatencies = [stats.created[postid] - stats.fetched[origin] for postid, origin in stats.origins.items() if origin in stats.fetched]
+	threadlatencies = [stats.lastcomment[postid] - stats.created[postid] for postid in stats.lastcomment]
+	results = {
+		"returncode": returncode,
+		"seconds": round(elapsed, 2),
+		"posts": stats.posts,
+		"comments": stats.comments,
+		"ratelimited": stats.ratelimited,
+		"rejected": stats.rejected,
+		"posts_per_second": round(stats.posts / elapsed, 2),
+		"comments_per_second": round(stats.comments / elapsed, 2),
+		"media_mb_per_second": round(stats.media_bytes / 1024 / 1024 / elapsed, 2),
+		"post_latency_p50": round(percentile(postlatencies, 0.5), 3),
+		"post_latency_p99": round(percentile(postlatencies, 0.99), 3),
+		"thread_latency_p50": round(percentile(threadlatencies, 0.5), 3),
+		"thread_latency_p99": round(percentile(threadlatencies, 0.99), 3),
+		# Linux reports it in kilobytes
+		"peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+		"requests": stats.requests
+	}
+	if options.json:
+		print(json.dumps(results, indent = 2))
+		return
+	print(f"Migrated {results['posts']} posts and {results['comments']} comments in {results['seconds']} seconds (exit code {returncode})")
+	print(f"Posts/s: {results['posts_per_second']}  Comments/s: {results['comments_per_second']}  Media MB/s: {results['media_mb_per_second']}")
+	print(f"Post latency p50/p99: {results['post_latency_p50']}s / {results['post_latency_p99']}s")
+	print(f"Thread latency p50/p99: {results['thread_latency_p50']}s / {results['thread_latency_p99']}s")
+	print(f"Rate limited requests: {results['ratelimited']}  Peak RSS: {results['peak_rss_mb']} MB")
+	# Nothing should have been too long for Lemmy
+	if results["rejected"]:
+		print(f"Rejected bodies too long: {results['rejected']}")
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()